@@ -0,0 +1,157 @@
+"""
+Client benchmark suite against the local Chargify stand-in: throughput,
+p50/p99 latency and peak memory of getAll(), collected or page by page,
+getById(), save() and the bulk paths (updateAllocations(),
+getByCustomerIds(), postbacks).
+
+Each scenario is timed once as is and run once more under tracemalloc
+for its peak memory, which slows it down. Injected errors are retried
+where the client retries them; calls that still fail are counted.
+
+    python benchmarks/bench_client.py [customers] [latency-ms] [error-%] [padding]
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify.scheduler import RequestScheduler
+
+from standin import CUSTOMER_IDS, StandIn
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def get_all(chargify, customers):
+    def run():
+        chargify.Customer().getAll()
+    return [run] * 5, customers * 5
+
+
+def get_all_records(chargify, customers):
+    def run():
+        chargify.Customer().getAll(records=True)
+    return [run] * 5, customers * 5
+
+
+def get_all_pages(chargify, customers):
+    def run():
+        chargify.Customer().getAll(per_page=200,
+            on_page=lambda page, customers: None)
+    return [run] * 5, customers * 5
+
+
+def get_by_id(chargify, customers):
+    subscription = chargify.Subscription()
+    ids = range(1, min(customers, 200) + 1)
+    return [(lambda id=id: subscription.getById(id)) for id in ids], len(ids)
+
+
+def save(chargify, customers):
+    def run(n):
+        customer = chargify.Customer()
+        customer.first_name = 'Jane'
+        customer.last_name = 'Doe'
+        customer.email = 'jane%d@example.com' % n
+        customer.reference = 'jane%d' % n
+        customer.save()
+    return [(lambda n=n: run(n)) for n in range(100)], 100
+
+
+def update_allocations(chargify, customers):
+    allocations = [(n, 500 + n % 7, n % 10) for n in range(1, customers + 1)]
+
+    def run():
+        results = chargify.SubscriptionComponent().updateAllocations(
+            allocations, workers=8)
+        if not all([result.ok for result in results]):
+            raise Exception('allocation update failed')
+    return [run], len(allocations)
+
+
+def get_by_customer_ids(chargify, customers):
+    ids = [CUSTOMER_IDS + n for n in range(1, customers + 1)]
+
+    def run():
+        for customer_id, subscriptions in \
+                chargify.Subscription().getByCustomerIds(ids, workers=8):
+            pass
+    return [run], len(ids)
+
+
+def postback(chargify, customers):
+    data = json.dumps(list(range(1, min(customers, 500) + 1)))
+
+    def run():
+        if chargify.PostBack(data, workers=8).errors:
+            raise Exception('postback subscription failed')
+    return [run], min(customers, 500)
+
+
+SCENARIOS = (
+    ('getAll()', get_all),
+    ('getAll(records=True)', get_all_records),
+    ('getAll(on_page=...)', get_all_pages),
+    ('getById()', get_by_id),
+    ('save()', save),
+    ('updateAllocations()', update_allocations),
+    ('getByCustomerIds()', get_by_customer_ids),
+    ('PostBack', postback),
+)
+
+
+def run(calls):
+    """
+    Make the calls one after the other, returning their durations and the
+    number of calls that failed
+    """
+    durations = []
+    failed = 0
+    for call in calls:
+        started = time.perf_counter()
+        try:
+            call()
+        except Exception:
+            failed += 1
+        durations.append(time.perf_counter() - started)
+    return durations, failed
+
+
+def main(customers=1000, latency=2, errors=0, padding=0):
+    standin = StandIn(customers, latency=latency / 1000.0,
+        error_rate=errors / 100.0, padding=padding).start()
+    # retry injected errors at once
+    chargify = standin.client(scheduler=RequestScheduler(backoff=0),
+        pool_size=8)
+    print('%d customers, %d ms latency, %d%% errors, %d bytes of padding' % (
+        customers, latency, errors, padding))
+    print('  %-22s %6s %7s %12s %10s %10s %10s %9s' % ('scenario', 'calls',
+        'failed', 'objects/s', 'p50 ms', 'p99 ms', 'peak MB', 'requests'))
+    for name, scenario in SCENARIOS:
+        calls, objects = scenario(chargify, customers)
+        standin.reset()
+        durations, failed = run(calls)
+        requests = standin.requests
+        elapsed = sum(durations)
+
+        tracemalloc.start()
+        run(calls)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print('  %-22s %6d %7d %12.0f %10.2f %10.2f %10.2f %9d' % (name,
+            len(calls), failed, objects / elapsed,
+            percentile(durations, 50) * 1000,
+            percentile(durations, 99) * 1000, peak / 1048576.0, requests))
+    standin.stop()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:5]])
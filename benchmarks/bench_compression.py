@@ -0,0 +1,101 @@
+"""
+Bytes on the wire and wall-clock time of fetching and decoding pages of
+subscriptions, with and without gzip compressed responses, from a local
+stub server. The stub can limit its bandwidth to mimic a real link.
+
+    python benchmarks/bench_compression.py [records-per-page] [pages] [mbit/s ...]
+"""
+import gzip
+import os
+import socket
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify import api
+from chargify.pychargify.instrumentation import RequestStats
+
+import fixtures
+
+
+def serve(body, bandwidth=None):
+    """
+    Serve body for every request, gzip compressed when accepted, at most
+    bandwidth bytes per second. Returns the server.
+    """
+    compressed = gzip.compress(body, 6)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def do_GET(self):
+            data = body
+            self.send_response(200)
+            if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                data = compressed
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Type', 'application/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if not bandwidth:
+                self.wfile.write(data)
+                return
+            for i in range(0, len(data), 16384):
+                chunk = data[i:i + 16384]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / bandwidth)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run(server, compress, pages):
+    stats = RequestStats()
+    chargify = api.Chargify('api-key', '127.0.0.1:%d' % server.server_port,
+        base_host='', secure=False, compress=compress, observers=[stats],
+        prefetch_pages=1)
+    subscriptions = chargify.Subscription()
+    started = time.perf_counter()
+    for page in range(1, pages + 1):
+        subscriptions._get_page('/subscriptions.xml', page)
+    elapsed = time.perf_counter() - started
+    bytes_in = sum([e.bytes_in for e in stats.endpoints.values()])
+    return bytes_in / pages, elapsed / pages
+
+
+def main(count=200, pages=20, *bandwidths):
+    body = fixtures.subscription_page(count)
+    print('%d pages of %d subscriptions, %.1f KB uncompressed' % (pages,
+        count, len(body) / 1024.0))
+    for mbits in bandwidths or (0, 100, 10):
+        server = serve(body, mbits * 125000)
+        label = '%d Mbit/s' % mbits if mbits else 'unlimited'
+        results = []
+        for name, compress in (('identity', False), ('gzip', True)):
+            run(server, compress, 1)
+            size, elapsed = run(server, compress, pages)
+            results.append(elapsed)
+            print('  %-10s %-9s %9.1f KB/page on the wire %8.2f ms/page' % (
+                label, name, size / 1024.0, elapsed * 1000))
+        print('  %-10s speedup: %.2fx' % (label, results[0] / results[1]))
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
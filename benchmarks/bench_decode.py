@@ -0,0 +1,88 @@
+"""
+Decode time per subscription page, from the response body as it comes
+off the wire: the ElementTree decoder in pychargify.api against the former
+fix_xml_encoding() and minidom decoder, which serialized every nested
+customer/product/credit_card node back to XML with toxml() and parsed it
+again.
+
+    python benchmarks/bench_decode.py [records-per-page] [repeat]
+"""
+import datetime
+import os
+import sys
+import timeit
+
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify import api, iso8601
+
+import fixtures
+
+
+def _legacy_xml_value(nodelist):
+    rc = ""
+    for node in nodelist:
+        if node.nodeType == node.TEXT_NODE:
+            rc = rc + node.data
+    return rc
+
+
+def _legacy_object_from_node(base, node, obj_type):
+    obj = getattr(api, obj_type)(base.api_key, base.sub_domain)
+    for childnodes in node.childNodes:
+        if childnodes.nodeType == 1 and not childnodes.nodeName == '':
+            if childnodes.nodeName in base.__attribute_types__:
+                obj.__setattr__(childnodes.nodeName,
+                    _legacy_applyS(base, childnodes.toxml(encoding='utf-8'),
+                        base.__attribute_types__[childnodes.nodeName],
+                        childnodes.nodeName))
+            else:
+                node_value = _legacy_xml_value(childnodes.childNodes)
+                if "type" in childnodes.attributes.keys():
+                    node_type = childnodes.attributes["type"]
+                    if node_value:
+                        if node_type.nodeValue == 'datetime':
+                            node_value = datetime.datetime.fromtimestamp(
+                                iso8601.parse(node_value))
+                obj.__setattr__(childnodes.nodeName, node_value)
+    return obj
+
+
+def _legacy_applyS(base, xml, obj_type, node_name):
+    nodes = minidom.parseString(xml).getElementsByTagName(node_name)
+    if nodes.length == 1:
+        return _legacy_object_from_node(base, nodes[0], obj_type)
+
+
+def legacy_applyA(base, xml, obj_type, node_name):
+    nodes = minidom.parseString(xml).getElementsByTagName(node_name)
+    return [_legacy_object_from_node(base, node, obj_type) for node in nodes]
+
+
+def main(count=200, repeat=5):
+    base = api.ChargifySubscription('api-key', 'subdomain')
+    body = fixtures.subscription_page(count)
+
+    def legacy():
+        legacy_applyA(base, base.fix_xml_encoding(body),
+            'ChargifySubscription', 'subscription')
+
+    def current():
+        base._applyA(body, 'ChargifySubscription', 'subscription')
+
+    print('decode of a %d subscription page, best of %d' % (count, repeat))
+    results = {}
+    for name, func in (('minidom + toxml round trip', legacy),
+            ('ElementTree pull parser', current)):
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+        print('  %-28s %8.2f ms/page %8.1f us/record' % (name,
+            results[name] * 1000, results[name] * 1e6 / count))
+    before, after = results.values()
+    print('  speedup: %.1fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
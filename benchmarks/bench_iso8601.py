@@ -0,0 +1,55 @@
+"""
+Time to turn a Chargify timestamp into a datetime: the former
+datetime.fromtimestamp(iso8601.parse(s)) against iso8601.parse_datetime(),
+both for distinct timestamps (nothing cached) and for the repeated ones a
+listing is full of.
+
+    python benchmarks/bench_iso8601.py [timestamps] [repeat]
+"""
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify import iso8601
+
+
+def timestamps(count):
+    start = datetime.datetime(2011, 3, 1, 10, 0, 0)
+    return [(start + datetime.timedelta(seconds=37 * i)).strftime(
+        '%Y-%m-%dT%H:%M:%S-05:00') for i in range(count)]
+
+
+def main(count=10000, repeat=5):
+    values = timestamps(count)
+    repeated = values[:50] * (count // 50)
+
+    def legacy():
+        for value in values:
+            datetime.datetime.fromtimestamp(iso8601.parse(value))
+
+    def distinct():
+        iso8601.parse_datetime.cache_clear()
+        for value in values:
+            iso8601.parse_datetime(value)
+
+    def cached():
+        for value in repeated:
+            iso8601.parse_datetime(value)
+
+    print('parse of %d timestamps, best of %d' % (count, repeat))
+    results = []
+    for name, func in (('fromtimestamp(parse())', legacy),
+            ('parse_datetime(), distinct', distinct),
+            ('parse_datetime(), repeated', cached)):
+        results.append(min(timeit.repeat(func, number=1, repeat=repeat)))
+        print('  %-28s %8.2f ms %8.2f us/timestamp  %5.1fx' % (name,
+            results[-1] * 1000, results[-1] * 1e6 / count,
+            results[0] / results[-1]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
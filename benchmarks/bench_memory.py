@@ -0,0 +1,55 @@
+"""
+Memory held by decoded subscriptions (each with its customer, product,
+product family and components): full ChargifySubscription objects against
+the read-only Records returned by iterAll(records=True).
+
+    python benchmarks/bench_memory.py [subscriptions] [records-per-page]
+"""
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify import api
+
+import fixtures
+
+
+def retained(base, pages, records):
+    """
+    Decode every page and return the bytes still allocated while the
+    results are kept
+    """
+    gc.collect()
+    tracemalloc.start()
+    kept = []
+    for body in pages:
+        kept.extend(base._applyA(body, 'ChargifySubscription', 'subscription',
+            records))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, len(kept)
+
+
+def main(count=10000, per_page=200):
+    base = api.ChargifySubscription('api-key', 'subdomain')
+    pages = [fixtures.subscription_page(per_page, start)
+        for start in range(1, count + 1, per_page)]
+
+    print('memory retained by %d decoded subscriptions' % count)
+    results = []
+    for name, records in (('ChargifySubscription objects', False),
+            ('records', True)):
+        size, decoded = retained(base, pages, records)
+        results.append(size)
+        print('  %-30s %8.1f MB %8d bytes/subscription' % (name,
+            size / 1048576.0, size // decoded))
+    print('  reduction: %.1fx' % (results[0] / float(results[1])))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,62 @@
+"""
+Time and peak memory of turning a raw subscription page into records: the
+former fix_xml_encoding() pass, which decoded, split, stripped, joined and
+re-encoded the whole body before parsing it, against decoding the body a
+chunk at a time inside the streaming parser.
+
+    python benchmarks/bench_normalize.py [records-per-page] [repeat]
+"""
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify import api
+
+import fixtures
+
+
+def peak(func):
+    """
+    Peak memory allocated while func runs, in bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    func()
+    size = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size
+
+
+def main(count=1000, repeat=5):
+    base = api.ChargifySubscription('api-key', 'subdomain')
+    body = fixtures.subscription_page(count)
+
+    def legacy():
+        base._applyA(base.fix_xml_encoding(body), 'ChargifySubscription',
+            'subscription', True)
+
+    def current():
+        base._applyA(body, 'ChargifySubscription', 'subscription', True)
+
+    print('normalize and decode a %d subscription page of %.1f KB, best of %d'
+        % (count, len(body) / 1024.0, repeat))
+    results = []
+    for name, func in (('fix_xml_encoding() + parse', legacy),
+            ('streaming decode + parse', current)):
+        elapsed = min(timeit.repeat(func, number=1, repeat=repeat))
+        size = peak(func)
+        results.append((elapsed, size))
+        print('  %-28s %8.2f ms/page %8.1f KB peak' % (name, elapsed * 1000,
+            size / 1024.0))
+    (before, before_size), (after, after_size) = results
+    print('  speedup: %.2fx, peak memory: %.1fx less' % (before / after,
+        before_size / float(after_size)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,66 @@
+"""
+Listing and decoding subscriptions offline from a cassette. The listing is
+recorded once from the local stand-in, in production-sized pages of 200,
+then replayed from the memory-mapped cassette. Replay time is client time
+alone, so it tracks regressions in decoding without network noise.
+
+    python benchmarks/bench_replay.py [subscriptions] [repeat] [cassette]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify import api
+from chargify.pychargify.connection import get_pool
+from chargify.pychargify.transport import RecordingTransport, ReplayTransport
+
+from standin import StandIn
+
+PER_PAGE = 200
+
+
+def list_all(chargify, records=False):
+    return sum([len(page) for page in
+        chargify.Subscription().iterPages(PER_PAGE, records=records)])
+
+
+def record(path, count):
+    with StandIn(count, latency=0.005) as standin:
+        recorder = RecordingTransport(path, get_pool(standin.host,
+            secure=False))
+        started = time.perf_counter()
+        list_all(standin.client(transport=recorder))
+        elapsed = time.perf_counter() - started
+        recorder.close()
+    return elapsed
+
+
+def main(count=5000, repeat=5, path=None):
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'subscriptions.cassette')
+    if not os.path.exists(path):
+        elapsed = record(path, count)
+        print('recorded %d subscriptions to %s (%.1f MB) in %.0f ms' % (count,
+            path, os.path.getsize(path) / 1048576.0, elapsed * 1000))
+
+    replay = ReplayTransport(path)
+    chargify = api.Chargify('api-key', 'offline', transport=replay)
+    for name, records in (('objects', False), ('records', True)):
+        results = []
+        for i in range(repeat):
+            replay.rewind()
+            started = time.perf_counter()
+            decoded = list_all(chargify, records)
+            results.append(time.perf_counter() - started)
+        best = min(results)
+        print('  replay, %-8s %6d subscriptions %8.0f ms %8.0f/s' % (name,
+            decoded, best * 1000, decoded / best))
+    replay.close()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]] + sys.argv[3:4])
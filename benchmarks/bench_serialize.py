@@ -0,0 +1,89 @@
+"""
+Time to serialize decoded subscriptions, with their customer, product and
+credit card, into the request body of a save: the former minidom _toxml(),
+which built an Element tree per save and wrote it out with toxml(),
+against the serializer in pychargify.api writing straight into a bytes
+buffer. Both must produce the same bytes.
+
+    python benchmarks/bench_serialize.py [subscriptions] [repeat]
+"""
+import inspect
+import os
+import sys
+import timeit
+
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify import api
+
+import fixtures
+
+
+def _legacy_toxml(obj, dom):
+    element = minidom.Element(obj.__xmlnodename__)
+    for property, value in obj.__dict__.items():
+        if not property in obj.__ignore__ and not inspect.isfunction(value):
+            if property in obj.__attribute_types__:
+                if type(value) == list:
+                    node = minidom.Element(property)
+                    node.setAttribute('type', 'array')
+                    for v in value:
+                        child = _legacy_toxml(v, dom)
+                        if child is not None:
+                            node.appendChild(child)
+                    element.appendChild(node)
+                else:
+                    element.appendChild(_legacy_toxml(value, dom))
+            else:
+                # bools as Chargify sends them, the way they round tripped
+                # when values were decoded as strings
+                if isinstance(value, bool):
+                    value = str(value).lower()
+                node = minidom.Element(property)
+                node.appendChild(dom.createTextNode(str(value)))
+                element.appendChild(node)
+    return element
+
+
+def legacy_toxml(obj):
+    dom = minidom.Document()
+    dom.appendChild(_legacy_toxml(obj, dom))
+    return dom.toxml(encoding='utf-8')
+
+
+def main(count=1000, repeat=5):
+    base = api.ChargifySubscription('api-key', 'subdomain')
+    subscriptions = base._applyA(fixtures.subscription_page(count),
+        'ChargifySubscription', 'subscription')
+    for subscription in subscriptions:
+        subscription.customer.organization = 'Smith & Sons <"Ltd">'
+
+    for subscription in subscriptions:
+        if legacy_toxml(subscription) != subscription._toxml():
+            raise AssertionError('output differs for subscription %s' %
+                subscription.id)
+
+    def legacy():
+        for subscription in subscriptions:
+            legacy_toxml(subscription)
+
+    def current():
+        for subscription in subscriptions:
+            subscription._toxml()
+
+    print('serialize %d subscriptions, identical output, best of %d' % (
+        count, repeat))
+    results = []
+    for name, func in (('minidom toxml()', legacy),
+            ('bytes buffer serializer', current)):
+        results.append(min(timeit.repeat(func, number=1, repeat=repeat)))
+        print('  %-26s %8.2f ms %8.1f us/subscription' % (name,
+            results[-1] * 1000, results[-1] * 1e6 / count))
+    print('  speedup: %.1fx' % (results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
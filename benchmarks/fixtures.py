@@ -0,0 +1,117 @@
+"""
+Synthetic Chargify API payloads shaped like production responses
+"""
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+CUSTOMER = '''<customer>
+  <id type="integer">%(customer_id)d</id>
+  <first_name>José</first_name>
+  <last_name>Doe &amp; Sons</last_name>
+  <email>customer%(customer_id)d@example.com</email>
+  <organization>Example %(customer_id)d</organization>
+  <reference>customer%(customer_id)d</reference>
+  <created_at type="datetime">2011-03-01T10:00:00-05:00</created_at>
+  <updated_at type="datetime">2011-03-0%(day)dT11:22:33-05:00</updated_at>
+</customer>'''
+
+PRODUCT_FAMILY = '''<product_family>
+  <id type="integer">%(product_family_id)d</id>
+  <name>Family %(product_family_id)d</name>
+  <handle>family-%(product_family_id)d</handle>
+  <accounting_code></accounting_code>
+  <description>A product family</description>
+</product_family>'''
+
+PRODUCT = '''<product>
+  <id type="integer">%(product_id)d</id>
+  <price_in_cents type="integer">1000</price_in_cents>
+  <name>Product %(product_id)d</name>
+  <handle>product-%(product_id)d</handle>
+  <accounting_code></accounting_code>
+  <interval_unit>month</interval_unit>
+  <interval type="integer">1</interval>
+  <created_at type="datetime">2011-01-01T10:00:00-05:00</created_at>
+  <updated_at type="datetime">2011-01-01T10:00:00-05:00</updated_at>
+''' + PRODUCT_FAMILY + '''
+</product>'''
+
+COMPONENT = '''<component>
+  <id type="integer">%(component_id)d</id>
+  <name>Component %(component_id)d</name>
+  <kind>quantity_based_component</kind>
+  <product_family_id type="integer">%(product_family_id)d</product_family_id>
+  <price_per_unit_in_cents type="integer">150</price_per_unit_in_cents>
+  <pricing_scheme>per_unit</pricing_scheme>
+  <unit_name>seat</unit_name>
+  <created_at type="datetime">2011-01-01T10:00:00-05:00</created_at>
+  <updated_at type="datetime">2011-01-01T10:00:00-05:00</updated_at>
+</component>'''
+
+SUBSCRIPTION_COMPONENT = '''<component>
+  <component_id type="integer">%(component_id)d</component_id>
+  <subscription_id type="integer">%(subscription_id)d</subscription_id>
+  <name>Component %(component_id)d</name>
+  <kind>quantity_based_component</kind>
+  <unit_name>seat</unit_name>
+  <pricing_scheme>per_unit</pricing_scheme>
+  <allocated_quantity type="integer">5</allocated_quantity>
+  <enabled type="boolean">true</enabled>
+</component>'''
+
+SUBSCRIPTION = '''<subscription>
+  <id type="integer">%(subscription_id)d</id>
+  <state>active</state>
+  <balance_in_cents type="integer">0</balance_in_cents>
+  <current_period_started_at type="datetime">2011-03-01T10:00:00-05:00</current_period_started_at>
+  <current_period_ends_at type="datetime">2011-04-01T10:00:00-04:00</current_period_ends_at>
+  <trial_started_at type="datetime" nil="true"></trial_started_at>
+  <trial_ended_at type="datetime" nil="true"></trial_ended_at>
+  <activated_at type="datetime">2011-03-01T10:00:00-05:00</activated_at>
+  <expires_at type="datetime" nil="true"></expires_at>
+  <created_at type="datetime">2011-03-01T10:00:00-05:00</created_at>
+  <updated_at type="datetime">2011-03-0%(day)dT11:22:33-05:00</updated_at>
+  <next_assessment_at type="datetime">2011-04-01T10:00:00-04:00</next_assessment_at>
+  <cancel_at_end_of_period type="boolean">false</cancel_at_end_of_period>
+''' + CUSTOMER + '\n' + PRODUCT + '''
+<credit_card>
+  <first_name>Joe</first_name>
+  <last_name>Doe</last_name>
+  <masked_card_number>XXXX-XXXX-XXXX-1111</masked_card_number>
+  <card_type>visa</card_type>
+  <expiration_month type="integer">10</expiration_month>
+  <expiration_year type="integer">2020</expiration_year>
+</credit_card>
+</subscription>'''
+
+
+def _values(n):
+    return {
+        'subscription_id': n,
+        'customer_id': 100000 + n,
+        'product_id': 10 + n % 5,
+        'product_family_id': 1 + n % 2,
+        'component_id': 500 + n % 7,
+        'day': 1 + n % 9,
+    }
+
+
+def record(template, n):
+    return template % _values(n)
+
+
+def page(template, root, count, start=1):
+    """
+    Return a listing page of `count` records as an UTF-8 encoded document
+    """
+    return (XML_DECLARATION + '<%s type="array">\n' % root +
+        '\n'.join(record(template, n) for n in range(start, start + count)) +
+        '\n</%s>\n' % root).encode('utf-8')
+
+
+def subscription_page(count=200, start=1):
+    return page(SUBSCRIPTION, 'subscriptions', count, start)
+
+
+def customer_page(count=200, start=1):
+    return page(CUSTOMER, 'customers', count, start)
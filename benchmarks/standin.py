@@ -0,0 +1,328 @@
+"""
+A local stand-in for the parts of the Chargify API the client uses, to
+measure and exercise the client without a Chargify account. XML only.
+
+Serves, with Chargify's paging (page, per_page) and updated_at date filter
+(date_field, start_datetime) on the paged listings:
+
+    GET  /customers.xml, /customers/:id.xml, /customers/lookup.xml
+    POST /customers.xml                  PUT /customers/:id.xml
+    GET  /customers/:id/subscriptions.xml
+    GET  /subscriptions.xml, /subscriptions/:id.xml
+    PUT  /subscriptions/:id.xml          DELETE /subscriptions/:id.xml
+    GET  /products.xml, /products/:id.xml, /products/handle/:handle.xml
+    GET  /product_families.xml, /product_families/:id/components.xml
+    GET  /subscriptions/:id/components.xml
+    PUT  /subscriptions/:id/components/:id.xml
+    GET  /subscriptions/:id/components/:id/usages.xml
+    POST /subscriptions/:id/components/:id/usages.xml
+
+The catalog and the records come from fixtures: customer n has id
+100000 + n and one subscription, n. Saves are echoed back and not kept. Every response waits `latency`
+seconds, plus up to `jitter` more, and a share `error_rate` of the
+requests fail with `error_status` instead. `padding` characters of notes
+are added to every record to make payloads bigger.
+
+    python benchmarks/standin.py [port] [customers]
+"""
+import datetime
+import os
+import random
+import re
+import socket
+import ssl
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.etree import ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from chargify.pychargify import api
+
+import fixtures
+
+CUSTOMER_IDS = 100000
+PRODUCT_IDS = range(10, 15)
+PRODUCT_FAMILY_IDS = range(1, 3)
+COMPONENT_IDS = range(500, 507)
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 200
+
+
+class StandIn(object):
+    """
+    The stand-in server, serving in a background thread once started.
+    requests and errors count the requests served and the errors injected.
+    """
+
+    def __init__(self, customers=1000, latency=0.0, jitter=0.0,
+            error_rate=0.0, error_status=503, padding=0, port=0,
+            certfile=None, keyfile=None, seed=0):
+        self.customers = customers
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.padding = padding
+        self.port = port
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._created = 0
+        self._usages = 0
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self._server.server_port
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port),
+            self._handler())
+        self._server.daemon_threads = True
+        if self.certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self._server.socket = context.wrap_socket(self._server.socket,
+                server_side=True)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def client(self, **options):
+        """
+        Return a Chargify client talking to the stand-in; served over
+        HTTPS only when the client trusts its certificate
+        """
+        options.setdefault('secure', bool(self.certfile))
+        return api.Chargify('api-key', self.host, base_host='', **options)
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+
+    # Request handling
+
+    def _delay(self):
+        """
+        Return the time to wait before responding, and whether to fail
+        """
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.random() * self.jitter
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        return delay, fail
+
+    def _record(self, template, n):
+        text = fixtures.record(template, n)
+        if self.padding:
+            root = text[1:text.index('>')]
+            text = text[:-len('</%s>' % root)] + '<notes>%s</notes></%s>' % (
+                'x' * self.padding, root)
+        return text
+
+    def _updated_at(self, n):
+        return datetime.datetime(2011, 3, fixtures._values(n)['day'], 16, 22,
+            33, tzinfo=datetime.timezone.utc)
+
+    def _page(self, template, root, numbers, query):
+        if query.get('date_field') == 'updated_at' and \
+                'start_datetime' in query:
+            since = datetime.datetime.fromisoformat(query['start_datetime'])
+            numbers = [n for n in numbers if self._updated_at(n) >= since]
+        per_page = min(int(query.get('per_page', DEFAULT_PER_PAGE)),
+            MAX_PER_PAGE)
+        page = int(query.get('page', 1))
+        numbers = numbers[(page - 1) * per_page:page * per_page]
+        return self._array(template, root, numbers)
+
+    def _array(self, template, root, numbers):
+        return '%s<%s type="array">%s</%s>' % (fixtures.XML_DECLARATION, root,
+            ''.join([self._record(template, n) for n in numbers]), root)
+
+    def _single(self, template, n):
+        return fixtures.XML_DECLARATION + self._record(template, n)
+
+    def _saved(self, body, id):
+        """
+        Echo a saved object back with its id and timestamps set
+        """
+        element = ElementTree.fromstring(body)
+        for name in ('id', 'created_at', 'updated_at'):
+            for child in element.findall(name):
+                element.remove(child)
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        for name, value, kind in (('id', str(id), 'integer'),
+                ('created_at', now, 'datetime'),
+                ('updated_at', now, 'datetime')):
+            child = ElementTree.SubElement(element, name, type=kind)
+            child.text = value
+        return fixtures.XML_DECLARATION + ElementTree.tostring(element,
+            encoding='unicode')
+
+    def _customer(self, customer_id):
+        n = int(customer_id) - CUSTOMER_IDS
+        if 1 <= n <= self.customers:
+            return n
+
+    def _subscription(self, subscription_id):
+        n = int(subscription_id)
+        if 1 <= n <= self.customers:
+            return n
+
+    def respond(self, method, path, query, body):
+        """
+        Return the (status, body) of a request
+        """
+        everyone = range(1, self.customers + 1)
+        route = path.rsplit('.', 1)[0].strip('/').split('/')
+        if route == ['customers']:
+            if method == 'POST':
+                with self._lock:
+                    self._created += 1
+                    id = CUSTOMER_IDS + self.customers + self._created
+                return 201, self._saved(body, id)
+            return 200, self._page(fixtures.CUSTOMER, 'customers', everyone,
+                query)
+        if route == ['customers', 'lookup']:
+            match = re.match(r'customer(\d+)$', query.get('reference', ''))
+            n = match and self._customer(CUSTOMER_IDS + int(match.group(1)))
+            if n:
+                return 200, self._single(fixtures.CUSTOMER, n)
+        elif route[0] == 'customers' and len(route) >= 2:
+            n = self._customer(route[1])
+            if n is None:
+                return 404, ''
+            if len(route) == 3 and route[2] == 'subscriptions':
+                return 200, self._array(fixtures.SUBSCRIPTION, 'subscriptions',
+                    [n])
+            if method == 'PUT':
+                return 200, self._saved(body, route[1])
+            return 200, self._single(fixtures.CUSTOMER, n)
+        elif route == ['subscriptions']:
+            return 200, self._page(fixtures.SUBSCRIPTION, 'subscriptions',
+                everyone, query)
+        elif route[0] == 'subscriptions':
+            n = self._subscription(route[1])
+            if n is None:
+                return 404, ''
+            if len(route) == 2:
+                if method == 'DELETE':
+                    return 200, ''
+                return 200, self._single(fixtures.SUBSCRIPTION, n)
+            if route[2] == 'components':
+                if len(route) == 3:
+                    return 200, self._array(fixtures.SUBSCRIPTION_COMPONENT,
+                        'components', [n])
+                if len(route) == 4:
+                    return 200, self._single(fixtures.SUBSCRIPTION_COMPONENT,
+                        n)
+                if method == 'POST':
+                    with self._lock:
+                        self._usages += 1
+                    return 200, self._saved(body, self._usages)
+                return 200, '%s<usages type="array"></usages>' % (
+                    fixtures.XML_DECLARATION)
+            # reset_balance, reactivate, charges
+            if method in ('PUT', 'POST'):
+                return 200, self._single(fixtures.SUBSCRIPTION, n)
+        elif route == ['products']:
+            return 200, self._array(fixtures.PRODUCT, 'products',
+                [n - 10 for n in PRODUCT_IDS])
+        elif route[:2] == ['products', 'handle']:
+            match = re.match(r'product-(\d+)$', route[2])
+            if match and int(match.group(1)) in PRODUCT_IDS:
+                return 200, self._single(fixtures.PRODUCT,
+                    int(match.group(1)) - 10)
+        elif route[0] == 'products':
+            if int(route[1]) in PRODUCT_IDS:
+                return 200, self._single(fixtures.PRODUCT, int(route[1]) - 10)
+        elif route == ['product_families']:
+            return 200, self._array(fixtures.PRODUCT_FAMILY,
+                'product_families', [n - 1 for n in PRODUCT_FAMILY_IDS])
+        elif route[0] == 'product_families' and route[2:] == ['components']:
+            family = int(route[1])
+            return 200, self._array(fixtures.COMPONENT, 'components',
+                [n - 500 for n in COMPONENT_IDS if 1 + (n - 500) % 2 == family])
+        return 404, ''
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                self.request.setsockopt(socket.IPPROTO_TCP,
+                    socket.TCP_NODELAY, 1)
+
+            def do_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                delay, fail = standin._delay()
+                if delay:
+                    time.sleep(delay)
+                if fail:
+                    status, data = standin.error_status, ''
+                else:
+                    url = urlsplit(self.path)
+                    query = dict((k, v[0]) for k, v in
+                        parse_qs(url.query).items())
+                    try:
+                        status, data = standin.respond(self.command, url.path,
+                            query, body)
+                    except (ValueError, IndexError, ElementTree.ParseError):
+                        status, data = 422, ''
+                data = data.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type',
+                    'application/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_request
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main(port=3000, customers=1000):
+    standin = StandIn(customers, port=port).start()
+    print('Chargify stand-in serving %d customers at http://%s' % (customers,
+        standin.host))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
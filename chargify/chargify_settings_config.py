@@ -1,6 +1,9 @@
 CHARGIFY_SUBDOMAIN = "your default subdomain on chargify"
 CHARGIFY_API_KEY = "your chargify api key"
 
+# Optional: cache catalog responses in this cache from CACHES
+# CHARGIFY_CACHE = "default"
+
 CHARGIFY_CC_TYPES = (
          ('Visa', 'Visa'),
          ('MasterCard', 'MasterCard'),
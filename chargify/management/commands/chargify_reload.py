@@ -1,11 +1,36 @@
 from django.core.management.base import BaseCommand
 
 from chargify.models import Subscription, Customer
+from chargify.pychargify.instrumentation import RequestStats
+from chargify.settings import CHARGIFY
 
 class Command(BaseCommand):
     args = ''
     help = 'Reload all the customers and subscriptions from Chargify. IT MAY TAKE AWHILE TO RUN.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--stats', action='store_true', default=False,
+            help='Print per-endpoint request statistics when done.')
+        parser.add_argument('--incremental', action='store_true',
+            default=False,
+            help='Only sync the customers and subscriptions changed since '
+                'the last incremental sync.')
+
     def handle(self, *args, **options):
-        Customer.objects.reload_all()
-        Subscription.objects.reload_all()
+        stats = None
+        if options.get('stats'):
+            stats = RequestStats()
+            CHARGIFY.options.setdefault('observers', []).append(stats)
+        try:
+            if options.get('incremental'):
+                for model in (Customer, Subscription):
+                    count = model.objects.sync_changed()
+                    self.stdout.write('%d %s changed\n' % (count,
+                        model._meta.verbose_name_plural))
+            else:
+                Customer.objects.reload_all()
+                Subscription.objects.reload_all()
+        finally:
+            if stats is not None:
+                CHARGIFY.options['observers'].remove(stats)
+                self.stdout.write(stats.dump() + '\n')
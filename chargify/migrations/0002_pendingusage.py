@@ -0,0 +1,24 @@
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chargify', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subscription_id', models.IntegerField()),
+                ('component_id', models.IntegerField()),
+                ('quantity', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=15)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('claim', models.CharField(db_index=True, max_length=32, null=True)),
+                ('claimed_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
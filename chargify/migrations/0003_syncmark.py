@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chargify', '0002_pendingusage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncMark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(max_length=50, unique=True)),
+                ('updated_at', models.DateTimeField(null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
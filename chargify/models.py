@@ -2,21 +2,38 @@ from chargify.settings import CHARGIFY, CHARGIFY_CC_TYPES
 from decimal import Decimal
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
 from django.utils.datetime_safe import new_datetime
 import datetime
 from chargify.pychargify.api import ChargifyNotFound
+from chargify.pychargify.usage import BaseUsageStore
 import logging
 import time
 import traceback
+import uuid
 from django.conf import settings
 log = logging.getLogger("chargify")
 #logging.basicConfig(level=logging.DEBUG)
 
+# How far chargify's clock may be behind ours; the high-water mark of an
+# incremental sync stays that far behind the time the sync started
+SYNC_CLOCK_SKEW = datetime.timedelta(minutes=5)
+
 
 def unique_reference(prefix = ''):
     return '%s%i' %(prefix, time.time()*1000)
 
 
+def from_api_datetime(value):
+    """ pychargify returns aware UTC datetimes, store them as naive local
+    time unless USE_TZ is on """
+    if not value:
+        return None
+    if not settings.USE_TZ and timezone.is_aware(value):
+        return timezone.make_naive(value)
+    return value
+
+
 class ChargifyBaseModel(object):
     """ You can change the gateway/subdomain used by
     changing the gateway on an instantiated object """
@@ -86,11 +103,51 @@ class ChargifyBaseManager(models.Manager):
 
     def reload_all(self):
         self._check_api()
-        items = self.api.getAll()
-        for item in items:
+        for item in self.api.iterAll():
             val = self.load_and_update(item.id)
             val.save()
 
+    def upsert(self, api):
+        """ Save the listed api object, creating or updating its row
+        without fetching it again """
+        try:
+            val = self.get(chargify_id=api.id)
+        except self.model.DoesNotExist:
+            val = self.model()
+        return val.load(api)
+
+    def sync_changed(self):
+        """ Upsert only the records updated in chargify since the last
+        sync, then move the high-water mark of the resource up to the latest
+        updated_at seen. The first sync lists everything. Returns the number
+        of records upserted.
+
+        The mark never moves past the time the sync started: a record
+        updated again after its page was listed is picked up by the next
+        sync, even when a later page held a record updated after it. """
+        self._check_api()
+        started_at = timezone.now() - SYNC_CLOCK_SKEW
+        mark, created = SyncMark.objects.get_or_create(
+            resource=self.api.Meta.listing)
+        since = mark.updated_at
+        if since is not None and timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        latest = mark.updated_at
+        count = 0
+        for item in self.api.iterAll(since=since):
+            self.upsert(item)
+            count += 1
+            updated_at = from_api_datetime(item.updated_at)
+            if updated_at and (latest is None or updated_at > latest):
+                latest = updated_at
+        if latest is not None and latest > started_at:
+            latest = max(started_at, mark.updated_at or started_at)
+        # only once every change is in, so an interrupted sync starts over
+        if latest != mark.updated_at:
+            mark.updated_at = latest
+            mark.save()
+        return count
+
 
 class CustomerManager(ChargifyBaseManager):
     def _api(self):
@@ -230,8 +287,9 @@ class Customer(models.Model, ChargifyBaseModel):
                 user.save()
             customer.user = user
         customer.organization = api.organization
-        customer.chargify_updated_at = api.modified_at
-        customer.chargify_created_at = api.created_at
+        customer.chargify_updated_at = from_api_datetime(
+            api.updated_at or api.modified_at)
+        customer.chargify_created_at = from_api_datetime(api.created_at)
         if commit:
             customer.save()
             log.debug("Saved customer '%s %s'." % (customer.first_name, customer.last_name))
@@ -421,9 +479,9 @@ class Component(models.Model, ChargifyBaseModel):
         self.pricing_scheme = api.pricing_scheme
 
         if api.created_at:
-            self.created_at = new_datetime(api.created_at)
+            self.created_at = from_api_datetime(api.created_at)
         if api.updated_at:
-            self.updated_at = new_datetime(api.updated_at)
+            self.updated_at = from_api_datetime(api.updated_at)
 
         try:
             pf = ProductFamily.objects.get(
@@ -717,8 +775,11 @@ class SubscriptionManager(ChargifyBaseManager):
         ProductFamily.objects.reload_all()
         Product.objects.reload_all()
 
-        for customer in Customer.objects.filter(active=True):
-            subscriptions = self.api.getByCustomerId(str(customer.chargify_id))
+        # fetched concurrently, saved here as they arrive
+        customer_ids = [str(customer.chargify_id)
+            for customer in Customer.objects.filter(active=True)]
+        for customer_id, subscriptions in self.api.getByCustomerIds(
+                customer_ids):
             if not subscriptions:
                 continue
             for subscription in subscriptions:
@@ -844,37 +905,37 @@ class Subscription(models.Model, ChargifyBaseModel):
         self.state = api.state
         self.balance_in_cents = api.balance_in_cents
         if api.current_period_started_at:
-            self.current_period_started_at = new_datetime(api.current_period_started_at)
+            self.current_period_started_at = from_api_datetime(api.current_period_started_at)
         else:
             self.current_period_started_at = None
         if api.current_period_ends_at:
-            self.current_period_ends_at = new_datetime(api.current_period_ends_at)
+            self.current_period_ends_at = from_api_datetime(api.current_period_ends_at)
         else:
             self.current_period_ends_at = None
         if api.trial_started_at:
-            self.trial_started_at = new_datetime(api.trial_started_at)
+            self.trial_started_at = from_api_datetime(api.trial_started_at)
         else:
             self.trial_started_at = None
         if api.trial_ended_at:
-            self.trial_ended_at = new_datetime(api.trial_ended_at)
+            self.trial_ended_at = from_api_datetime(api.trial_ended_at)
         else:
             self.trial_ended_at = None
         if api.activated_at:
-            self.activated_at = new_datetime(api.activated_at)
+            self.activated_at = from_api_datetime(api.activated_at)
         else:
             self.activated_at = None
         if api.expires_at:
-            self.expires_at = new_datetime(api.expires_at)
+            self.expires_at = from_api_datetime(api.expires_at)
         else:
             self.expires_at = None
         if api.next_assessment_at:
-            self.next_assessment_at = new_datetime(api.next_assessment_at)
+            self.next_assessment_at = from_api_datetime(api.next_assessment_at)
         else:
             self.next_assessment_at = None
         if api.created_at:
-            self.created_at = new_datetime(api.created_at)
+            self.created_at = from_api_datetime(api.created_at)
         if api.updated_at:
-            self.updated_at = new_datetime(api.updated_at)
+            self.updated_at = from_api_datetime(api.updated_at)
         try:
             c = Customer.objects.get(chargify_id = api.customer.id)
         except:
@@ -1052,3 +1113,69 @@ class SubscriptionComponent(models.Model, ChargifyBaseModel):
         component.enabled = self.enabled
         return component
     api = property(_api)
+
+
+class SyncMark(models.Model):
+    """ High-water mark of the incremental sync of a resource: the latest
+    updated_at seen in chargify """
+    resource = models.CharField(max_length=50, unique=True)
+    updated_at = models.DateTimeField(null=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s - %s' % (self.resource, self.updated_at)
+
+
+class PendingUsage(models.Model):
+    """ Metered usage recorded through a UsageAccumulator with a
+    PendingUsageStore, waiting to be sent to chargify """
+    subscription_id = models.IntegerField()
+    component_id = models.IntegerField()
+    quantity = models.DecimalField(
+        decimal_places = 2, max_digits = 15, default=Decimal('0.00'))
+    created_at = models.DateTimeField(auto_now_add=True)
+    claim = models.CharField(max_length=32, null=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return '%s x %s - %s' % (self.subscription_id, self.component_id,
+            self.quantity)
+
+
+class PendingUsageStore(BaseUsageStore):
+    """ Usage store keeping the pending usage in the database, so it
+    survives restarts and can be shared by several processes. Usage
+    claimed by a flush that did not finish within claim_timeout seconds is
+    claimed again by the next one. """
+
+    def __init__(self, claim_timeout=600):
+        self.claim_timeout = claim_timeout
+
+    def add(self, subscription_id, component_id, quantity):
+        PendingUsage.objects.create(subscription_id=subscription_id,
+            component_id=component_id, quantity=quantity)
+
+    def claim(self):
+        claim = uuid.uuid4().hex
+        now = timezone.now()
+        PendingUsage.objects.filter(
+            models.Q(claim__isnull=True) |
+            models.Q(claimed_at__lt=now - datetime.timedelta(
+                seconds=self.claim_timeout))
+        ).update(claim=claim, claimed_at=now)
+        usage = PendingUsage.objects.filter(claim=claim).values(
+            'subscription_id', 'component_id').annotate(
+            total=models.Sum('quantity'))
+        return [((u['subscription_id'], u['component_id']), u['total'],
+            (claim, u['subscription_id'], u['component_id'])) for u in usage]
+
+    def _claimed(self, token):
+        claim, subscription_id, component_id = token
+        return PendingUsage.objects.filter(claim=claim,
+            subscription_id=subscription_id, component_id=component_id)
+
+    def ack(self, token):
+        self._claimed(token).delete()
+
+    def release(self, token):
+        self._claimed(token).update(claim=None, claimed_at=None)
@@ -19,21 +19,345 @@ Created on Nov 20, 2009
 Author: Paul Trippett (paul@pyhub.com)
 '''
 
-import http
 import base64
+import codecs
 import time
 import datetime
-import iso8601
-import inspect
 import logging
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
 from itertools import chain
-from xml.dom import minidom
+from types import FunctionType
+from urllib.parse import urlencode
+from xml.etree import ElementTree
+
+from . import iso8601
+from .cache import LocalCache
+from .connection import ACCEPT_ENCODING, get_pool
+from .instrumentation import RequestEvent
+from .records import Record, record_type
+from .scheduler import RequestScheduler, default_scheduler
 
 log = logging.getLogger("pychargify")
 
 import json
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Number of bytes (or characters) handed to the XML parser at a time
+PARSE_CHUNK_SIZE = 16384
+
+# Number of pages of a paged listing requested concurrently
+DEFAULT_PREFETCH_PAGES = 4
+
+# Number of allocation updates sent concurrently by updateAllocations()
+DEFAULT_BULK_WORKERS = 4
+
+
+def _json_default(value):
+    """
+    Serialize the values the json module does not know about
+    """
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _json_dumps(value):
+    """
+    Return value serialized to JSON, as bytes
+    """
+    return json.dumps(value, default=_json_default).encode('utf-8')
+
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>'
+
+# Opening, closing and array opening tags of the elements written by the
+# serializer, by element name
+_XML_TAGS = {}
+
+
+def _xml_tags(name):
+    tags = _XML_TAGS.get(name)
+    if tags is None:
+        tags = _XML_TAGS[name] = ('<%s>' % name, '</%s>' % name,
+            '<%s type="array">' % name)
+    return tags
+
+
+def _xml_escape(value):
+    """
+    Return the text of value escaped for an XML element; bools are written
+    the way Chargify sends them
+    """
+    kind = type(value)
+    if kind is str:
+        text = value
+    elif kind is bool:
+        return 'true' if value else 'false'
+    elif kind is datetime.datetime and value.tzinfo is iso8601.UTC:
+        return _xml_escape_utc(value)
+    else:
+        text = str(value)
+    if '&' in text or '<' in text or '>' in text or '"' in text:
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace(
+            '"', '&quot;').replace('>', '&gt;')
+    return text
+
+
+@lru_cache(maxsize=iso8601.PARSE_CACHE_SIZE)
+def _xml_escape_utc(value):
+    """
+    Return the text of a UTC datetime. Decoded datetimes are in UTC and
+    shared by every object holding the same timestamp, so their text is
+    remembered like their parse; equal datetimes in other offsets would
+    not have the same text.
+    """
+    return str(value)
+
+
+def _encode_xml(parts, name, values):
+    """
+    Append the element name holding the (field, value) pairs of values to
+    the list of strings parts; dict values are written as nested elements
+    """
+    start, end, _ = _XML_TAGS.get(name) or _xml_tags(name)
+    append = parts.append
+    append(start)
+    for field, value in values:
+        if type(value) is dict:
+            _encode_xml(parts, field, value.items())
+            continue
+        field_start, field_end, _ = _XML_TAGS.get(field) or _xml_tags(field)
+        append(field_start)
+        append(_xml_escape(value))
+        append(field_end)
+    append(end)
+    return parts
+
+
+def _encode_object(parts, obj):
+    """
+    Append the element of obj to the list of strings parts, following the
+    fields its _fields() returns and its __attribute_types__: nested
+    objects are written as their own element, lists of them as an array,
+    and left out when empty. Nothing is written when obj has nothing to
+    send.
+    """
+    fields = obj._fields()
+    if fields is None:
+        return parts
+    ignored = obj._ignored()
+    types = obj.__attribute_types__
+    start, end, _ = _XML_TAGS.get(obj.__xmlnodename__) or \
+        _xml_tags(obj.__xmlnodename__)
+    append = parts.append
+    append(start)
+    for field, value in fields:
+        if field in ignored or ((value is None or value == '') and
+                field in types):
+            continue
+        field_start, field_end, array_start = _XML_TAGS.get(field) or \
+            _xml_tags(field)
+        kind = type(value)
+        # text with nothing to escape, the common case, is kept inline
+        if kind is str and not ('&' in value or '<' in value or
+                '>' in value or '"' in value):
+            append(field_start)
+            append(value)
+            append(field_end)
+        elif field in types:
+            if kind == list:
+                append(array_start)
+                for v in value:
+                    _encode_object(parts, v)
+                append(field_end)
+            else:
+                _encode_object(parts, value)
+        elif kind is not FunctionType:
+            append(field_start)
+            append(_xml_escape(value))
+            append(field_end)
+    append(end)
+    return parts
+
+
+def _xml_document(parts):
+    """
+    Return the request body made of the list of strings parts, encoded in
+    one go
+    """
+    return ''.join(parts).encode('utf-8')
+
+
+# Decoders of the text of an element by its type attribute, empty elements
+# (nil="true") decode to ''
+def _xml_text(element, make):
+    # whitespace around values is layout, not data; strip() returns the
+    # text itself when there is none
+    return (element.text or '').strip()
+
+
+def _xml_integer(element, make):
+    text = _xml_text(element, make)
+    return int(text) if text else ''
+
+
+def _xml_boolean(element, make):
+    text = _xml_text(element, make)
+    return text == 'true' if text else ''
+
+
+def _xml_datetime(element, make):
+    text = _xml_text(element, make)
+    return iso8601.parse_datetime(text) if text else ''
+
+
+def _decode_chunks(chunks):
+    """
+    Pass chunks of bytes on to the parser, which reads UTF-8 itself, as
+    long as they are valid UTF-8. Chargify encodes non-ascii characters in
+    CP1252, so from the first byte that is not valid UTF-8 on the chunks
+    are decoded from CP1252 here instead.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    cp1252 = None
+    for chunk in chunks:
+        if cp1252 is not None:
+            yield cp1252.decode(chunk)
+            continue
+        held = decoder.buffer
+        try:
+            decoder.decode(chunk)
+        except UnicodeDecodeError as e:
+            # the error is at an offset into the held bytes and the chunk,
+            # whatever comes before it is still UTF-8
+            data = held + chunk
+            if e.start:
+                yield data[:e.start]
+            cp1252 = codecs.getincrementaldecoder('cp1252')()
+            yield cp1252.decode(data[e.start:])
+            continue
+        # the decoder keeps back the start of a character split across
+        # chunks, including the one held over from the previous chunk
+        complete = len(held) + len(chunk) - len(decoder.buffer)
+        if complete:
+            if held:
+                yield held
+            yield chunk[:complete - len(held)]
+    if cp1252 is None and decoder.buffer:
+        yield decoder.buffer.decode('cp1252')
+
+
+XML_DECODERS = {
+    'integer': _xml_integer,
+    'boolean': _xml_boolean,
+    'datetime': _xml_datetime,
+}
+
+
+def _json_value(value, make):
+    return '' if value is None else value
+
+
+def _json_datetime(value, make):
+    if isinstance(value, str) and value:
+        return iso8601.parse_datetime(value)
+    return _json_value(value, make)
+
+
+def _make_record(constructor, values):
+    return constructor._record_type()(values)
+
+
+def _decode_xml(element, constructor, make):
+    """
+    Decode an element into an object of class constructor, created by
+    make(constructor, values)
+    """
+    plan = constructor._decode_plans()[0]
+    values = {}
+    for child in element:
+        tag = child.tag
+        # other fields by the type attribute of each element, which empty
+        # (nil) elements leave out
+        decode = plan.get(tag) or XML_DECODERS.get(child.get('type'),
+            _xml_text)
+        values[tag] = decode(child, make)
+    return make(constructor, values)
+
+
+def _decode_json(values, constructor, make):
+    """
+    Decode a JSON object into an object of class constructor, created by
+    make(constructor, values)
+    """
+    plan = constructor._decode_plans()[1]
+    decoded = {}
+    for key, value in values.items():
+        decode = plan.get(key)
+        if decode is None:
+            decode = plan[key] = _json_datetime if key.endswith('_at') \
+                else _json_value
+        decoded[key] = decode(value, make)
+    return make(constructor, decoded)
+
+
+def _nested_decoders(constructor):
+    """
+    Return the XML and JSON decoders of a field holding objects of class
+    constructor, either one object or an array of them. Arrays are lists,
+    or tuples inside records; a JSON null is None, like a missing field.
+    """
+    def decode_xml(element, make):
+        if element.get('type') != 'array':
+            return _decode_xml(element, constructor, make)
+        objs = [_decode_xml(child, constructor, make) for child in element]
+        return tuple(objs) if make is _make_record else objs
+
+    def decode_json(value, make):
+        if value is None:
+            return None
+        if not isinstance(value, list):
+            return _decode_json(value, constructor, make)
+        node_name = constructor.__xmlnodename__
+        objs = [_decode_json(v.get(node_name, v), constructor, make)
+            for v in value]
+        return tuple(objs) if make is _make_record else objs
+
+    return decode_xml, decode_json
+
+
+def _fan_out(func, items, workers):
+    """
+    Call func on every item, up to workers at a time, and yield (item,
+    future) pairs as the calls complete. A bounded number of calls is kept
+    queued; the calls not started yet are dropped when the caller stops
+    iterating.
+    """
+    items = iter(items)
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            for item in items:
+                pending[executor.submit(func, item)] = item
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+    finally:
+        executor.shutdown(cancel_futures=True)
+
 
 class ChargifyError(Exception):
     """
@@ -77,6 +401,14 @@ class ChargifyUnProcessableEntity(ChargifyError):
     pass
 
 
+class ChargifyTooManyRequests(ChargifyError):
+    """
+    The API rate limit was exceeded and retrying did not help.
+    @license    GNU General Public License
+    """
+    pass
+
+
 class ChargifyServerError(ChargifyError):
     """
     Signals some other error
@@ -97,114 +429,242 @@ class ChargifyBase(object):
         paged = False
 
     __ignore__ = ['api_key', 'sub_domain', 'base_host', 'request_host',
-        'id', '__xmlnodename__', 'Meta']
+        'id', '__xmlnodename__', 'Meta', 'options']
 
     api_key = ''
     sub_domain = ''
     base_host = '.chargify.com'
     request_host = ''
+    options = {}
 
-    def __init__(self, apikey, subdomain):
+    def __init__(self, apikey, subdomain, **options):
         """
         Initialize the Class with the API Key and SubDomain for Requests
-        to the Chargify API
+        to the Chargify API. The options are handed down to every object
+        created from this one; format='json' talks to the .json endpoints
+        instead of the .xml ones. base_host and secure=False point the
+        requests at another server, e.g. a local stand-in, over plain
+        HTTP. Responses are asked for gzip or deflate compressed unless
+        compress=False.
         """
         self.api_key = apikey
         self.sub_domain = subdomain
-        self.request_host = self.sub_domain + self.base_host
+        self.request_host = self.sub_domain + options.get('base_host',
+            self.base_host)
+        self.options = options
+
+    @property
+    def format(self):
+        return self.options.get('format', 'xml')
 
-    def __get_xml_value(self, nodelist):
+    @classmethod
+    def _record_type(cls):
         """
-        Get the Text Value from an XML Node
+        Return the Record class holding decoded objects of this class, with
+        a slot for every field declared on the class
         """
-        rc = ""
-        for node in nodelist:
-            if node.nodeType == node.TEXT_NODE:
-                rc = rc + node.data
-        return rc
-
-    def __get_object_from_node(self, node, obj_type=''):
+        record = cls.__dict__.get('_record')
+        if record is None:
+            defaults = {}
+            for klass in reversed(cls.__mro__):
+                for name, value in vars(klass).items():
+                    if name.startswith('_') or callable(value) or \
+                            isinstance(value, (property, classmethod)):
+                        continue
+                    if name == 'id' or name not in cls.__ignore__:
+                        defaults[name] = value
+            record = record_type(cls.__name__ + 'Record', cls.__name__,
+                defaults)
+            cls._record = record
+        return record
+
+    @classmethod
+    def _decode_plans(cls):
         """
-        Copy values from a node into a new Object
+        Return the (xml, json) decode plans of this class, dicts mapping a
+        field name to the function decoding its value. Nested objects are
+        planned from __attribute_types__ when first used. Other JSON fields
+        are added as they are first seen, from their name (*_at is a
+        datetime); other XML fields are not planned, each element is decoded
+        by its own type attribute.
         """
-        if obj_type == '':
-            constructor = globals()[self.__name__]
-        else:
-            constructor = globals()[obj_type]
-        obj = constructor(self.api_key, self.sub_domain)
-
-        for childnodes in node.childNodes:
-            if childnodes.nodeType == 1 and not childnodes.nodeName == '':
-                if childnodes.nodeName in self.__attribute_types__:
-
-                    obj.__setattr__(childnodes.nodeName,
-                        self._applyS(childnodes.toxml(encoding='utf-8'),
-                        self.__attribute_types__[childnodes.nodeName],
-                            childnodes.nodeName))
-                else:
-                    node_value = self.__get_xml_value(childnodes.childNodes)
-                    if "type" in  childnodes.attributes.keys():
-                        node_type = childnodes.attributes["type"]
-                        if node_value:
-                            if node_type.nodeValue == 'datetime':
-                                node_value = datetime.datetime.fromtimestamp(
-                                    iso8601.parse(node_value))
-                    obj.__setattr__(childnodes.nodeName, node_value)
+        plans = cls.__dict__.get('_plans')
+        if plans is None:
+            xml_plan, json_plan = {}, {}
+            for name, type_name in cls.__attribute_types__.items():
+                xml_plan[name], json_plan[name] = _nested_decoders(
+                    globals()[type_name])
+            plans = cls._plans = (xml_plan, json_plan)
+        return plans
+
+    def __new_object(self, constructor, values):
+        """
+        Return a new Object holding the decoded values. It shares the
+        options dict of this object instead of getting a copy of its own.
+        """
+        obj = constructor.__new__(constructor)
+        obj.api_key = self.api_key
+        obj.sub_domain = self.sub_domain
+        obj.request_host = self.request_host
+        obj.options = self.options
+        obj.__dict__.update(values)
         return obj
 
+    def fromRecord(self, record):
+        """
+        Return a full Object with the values of the passed Record, using the
+        API key, subdomain and options of this object
+        """
+        values = {}
+        for name, value in record.items():
+            if isinstance(value, Record):
+                value = self.fromRecord(value)
+            elif isinstance(value, tuple):
+                value = [self.fromRecord(v) for v in value]
+            values[name] = value
+        return self.__new_object(globals()[record._object_type], values)
+
     def fix_xml_encoding(self, xml):
         """
         Chargify encodes non-ascii characters in CP1252.
         Decodes and re-encodes with xml characters.
         Strips out whitespace "text nodes".
         """
+        if isinstance(xml, (bytes, bytearray)):
+            try:
+                xml = xml.decode('utf-8')
+            except UnicodeDecodeError:
+                xml = xml.decode('cp1252')
         return str(''.join([i.strip() for i in xml.split('\n')])
                 .encode('utf-8', 'xmlcharrefreplace'), 'utf-8')
 
+    def _iterparse(self, xml, node_name):
+        """
+        Stream the outermost elements called node_name out of the passed
+        xml data. The data is fed to the parser a chunk at a time and every
+        element is cleared and detached from the tree once the caller is
+        done with it, so at most one record is held in memory.
+
+        The data is a str, bytes, a bytearray or a binary file; bytes are
+        sliced through a memoryview and decoded a chunk at a time on their
+        way to the parser, so the response is never copied whole.
+        """
+        if hasattr(xml, 'read'):
+            chunks = _decode_chunks(iter(lambda: xml.read(PARSE_CHUNK_SIZE),
+                b''))
+        elif isinstance(xml, str):
+            chunks = (xml[i:i + PARSE_CHUNK_SIZE]
+                for i in range(0, len(xml), PARSE_CHUNK_SIZE))
+        else:
+            view = memoryview(xml)
+            chunks = _decode_chunks(view[i:i + PARSE_CHUNK_SIZE]
+                for i in range(0, len(view), PARSE_CHUNK_SIZE))
+
+        parser = ElementTree.XMLPullParser(('start', 'end'))
+        stack = []
+        record = None
+        for chunk in chain(chunks, [None]):
+            if chunk is None:
+                parser.close()
+            else:
+                parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    stack.append(element)
+                    if record is None and element.tag == node_name:
+                        record = element
+                    continue
+                stack.pop()
+                if element is record:
+                    yield element
+                    record = None
+                    element.clear()
+                    if stack:
+                        stack[-1].remove(element)
+
     def _applyS(self, xml, obj_type, node_name):
         """
         Apply the values of the passed xml data to the a class
         """
-        dom = minidom.parseString(xml)
-        nodes = dom.getElementsByTagName(node_name)
-        if nodes.length == 1:
-            return self.__get_object_from_node(nodes[0], obj_type)
-
-    def _applyA(self, xml, obj_type, node_name):
-        """
-        Apply the values of the passed data to a new class of the current type
-        """
-        dom = minidom.parseString(xml)
-        nodes = dom.getElementsByTagName(node_name)
-        objs = []
-        for node in nodes:
-            objs.append(self.__get_object_from_node(node, obj_type))
-        return objs
-
-    def _toxml(self, dom):
-        """
-        Return a XML Representation of the object
-        """
-        element = minidom.Element(self.__xmlnodename__)
-        for property, value in self.__dict__.iteritems():
-            if not property in self.__ignore__ and not inspect.isfunction(value):
-                if property in self.__attribute_types__:
-                    if type(value) == list:
-                        node = minidom.Element(property)
-                        node.setAttribute('type', 'array')
-                        for v in value:
-                            child = v._toxml(dom)
-                            if child is not None:
-                                node.appendChild(child)
-                        element.appendChild(node)
-                    else:
-                        element.appendChild(value._toxml(dom))
+        objs = self._applyA(xml, obj_type, node_name)
+        if len(objs) == 1:
+            return objs[0]
+
+    def _applyA(self, xml, obj_type, node_name, records=False):
+        """
+        Apply the values of the passed data to a new class of the current
+        type, or to Records when records is set
+        """
+        constructor = globals()[obj_type or self.__name__]
+        make = _make_record if records else self.__new_object
+        if self.format == 'json':
+            values = json_loads(xml)
+            if isinstance(values, dict):
+                values = [values]
+            return [_decode_json(v[node_name], constructor, make)
+                for v in values if node_name in v]
+        return [_decode_xml(node, constructor, make)
+            for node in self._iterparse(xml, node_name)]
+
+    def _fields(self):
+        """
+        Return the (name, value) pairs sent to Chargify when the object is
+        saved, or None when there is nothing to send. The serializers
+        leave out the names in __ignore__ and functions.
+        """
+        return self.__dict__.items()
+
+    @classmethod
+    def _ignored(cls):
+        """
+        Return __ignore__ as a set
+        """
+        ignored = cls.__dict__.get('_ignored_set')
+        if ignored is None:
+            ignored = cls._ignored_set = frozenset(cls.__ignore__)
+        return ignored
+
+    def _toxml(self):
+        """
+        Return a XML Representation of the object, as bytes
+        """
+        # the XML declaration minidom used to write
+        return _xml_document(_encode_object(
+            ['<?xml version="1.0" encoding="utf-8"?>'], self))
+
+    def _todict(self):
+        """
+        Return a JSON representation of the object as a dict
+        """
+        fields = self._fields()
+        if fields is None:
+            return None
+        ignored = self._ignored()
+        values = {}
+        for property, value in fields:
+            if property in ignored or isinstance(value, FunctionType):
+                continue
+            if property in self.__attribute_types__:
+                if value is None or value == '':
+                    continue
+                if type(value) == list:
+                    values[property] = [child for child in
+                        (v._todict() for v in value) if child is not None]
                 else:
-                    node = minidom.Element(property)
-                    node_txt = dom.createTextNode(str(value).encode('ascii', 'xmlcharrefreplace'))
-                    node.appendChild(node_txt)
-                    element.appendChild(node)
-        return element
+                    values[value.__xmlnodename__] = value._todict()
+            else:
+                values[property] = value
+        return values
+
+    def _payload(self, node_name, values):
+        """
+        Return the request body for a set of values in the current format;
+        dict values are nested
+        """
+        if self.format == 'json':
+            return _json_dumps({node_name: values})
+        return _xml_document(_encode_xml([XML_DECLARATION], node_name,
+            values.items()))
 
     def _get(self, url):
         """
@@ -212,6 +672,39 @@ class ChargifyBase(object):
         """
         return self._request('GET', url)
 
+    def _cache_ttl(self):
+        """
+        Seconds responses of this resource may be cached for: the
+        cache_ttls option for Meta.listing, else Meta.cache_ttl
+        """
+        return self.options.get('cache_ttls', {}).get(
+            getattr(self.Meta, 'listing', None),
+            getattr(self.Meta, 'cache_ttl', None))
+
+    def _get_cached(self, url, event=None):
+        """
+        Handle HTTP GETs to the API through the response cache (the cache
+        option), for resources that have a cache TTL
+        """
+        cache = self.options.get('cache')
+        ttl = self._cache_ttl()
+        if cache is None or not ttl:
+            return self._request('GET', url, None, event)
+        key = self.request_host + url
+        data = cache.get(self.Meta.listing, key)
+        if data is None:
+            data = self._request('GET', url, None, event)
+            cache.set(self.Meta.listing, key, data, ttl)
+        return data
+
+    def invalidateCache(self):
+        """
+        Drop the cached responses of this resource
+        """
+        cache = self.options.get('cache')
+        if cache is not None:
+            cache.invalidate(getattr(self.Meta, 'listing', None))
+
     def _post(self, url, data):
         """
         Handle HTTP POST's to the API
@@ -230,33 +723,138 @@ class ChargifyBase(object):
         """
         return self._request('DELETE', url, data)
 
-    def _request(self, method, url, data=None):
+    def _notify(self, event):
         """
-        Handled the request and sends it to the server
+        Report a finished request to the observers
         """
-        http_request = http.client.HTTPSConnection(self.request_host)
-
-        http_request.putrequest(method, url)
-        http_request.putheader("Authorization", "Basic %s" % self._get_auth_string())
-        http_request.putheader("User-Agent", "pychargify")
-        http_request.putheader("Host", self.request_host)
-        http_request.putheader("Accept", "application/xml")
+        for observer in self.options.get('observers') or ():
+            try:
+                observer.observe(event)
+            except Exception:
+                log.exception('request observer %r failed' % observer)
+
+    def _fetchA(self, method, url, obj_type, node_name, data=None,
+            cached=False, records=False):
+        """
+        Send a request and decode the objects called node_name out of the
+        response. The observers get one event covering both.
 
-        if data:
-            http_request.putheader("Content-Length", str(len(data)))
+        Identical GETs made concurrently through the singleflight option
+        are sent once; the callers share the decoded Records and get their
+        own objects made from them.
+        """
+        flights = self.options.get('singleflight')
+        if flights is None or method != 'GET':
+            return self._fetch(method, url, obj_type, node_name, data, cached,
+                records)
+        flight, leader = flights.join((self.api_key, self.request_host,
+            self.format, url, obj_type, node_name))
+        if leader:
+            try:
+                return self._fetch(method, url, obj_type, node_name, data,
+                    cached, records, flight)
+            except BaseException as e:
+                flight.finish(error=e)
+                raise
+        shared = flight.wait()
+        if records:
+            return list(shared)
+        return [self.fromRecord(r) for r in shared]
+
+    def _fetch(self, method, url, obj_type, node_name, data=None,
+            cached=False, records=False, flight=None):
+        """
+        Send a request and decode its response for _fetchA(), sharing the
+        decoded Records with the callers waiting on flight, if any
+        """
+        event = None
+        if self.options.get('observers'):
+            event = RequestEvent(method, url)
+        try:
+            if cached:
+                body = self._get_cached(url, event)
+            else:
+                body = self._request(method, url, data, event)
+            shared = flight is not None and not flight.detach()
+            started = time.perf_counter()
+            objs = self._applyA(body, obj_type, node_name, records or shared)
+            if event is not None:
+                event.parse_time = time.perf_counter() - started
+            if flight is not None:
+                flight.finish(tuple(objs) if shared else None)
+            if shared and not records:
+                objs = [self.fromRecord(r) for r in objs]
+            return objs
+        finally:
+            # no attempts were made when the response came from the cache
+            if event is not None and event.attempts:
+                self._notify(event)
+
+    def _fetchS(self, method, url, obj_type, node_name, data=None,
+            cached=False):
+        """
+        Send a request and decode the single object called node_name out
+        of the response
+        """
+        objs = self._fetchA(method, url, obj_type, node_name, data, cached)
+        if len(objs) == 1:
+            return objs[0]
 
-        http_request.putheader("Content-Type", 'text/xml; charset="UTF-8"')
-        http_request.endheaders()
+    def _request(self, method, url, data=None, event=None):
+        """
+        Handled the request and sends it to the server. The request is
+        reported to the observers here unless the caller passes its own
+        event to fill in.
+        """
+        own_event = event is None and bool(self.options.get('observers'))
+        if own_event:
+            event = RequestEvent(method, url)
+
+        headers = {
+            "Authorization": "Basic %s" % self._get_auth_string(),
+            "User-Agent": "pychargify",
+            "Host": self.request_host,
+            "Accept": "application/%s" % self.format,
+            "Content-Type": 'text/xml; charset="UTF-8"',
+        }
+        if self.format == 'json':
+            headers["Content-Type"] = 'application/json; charset="UTF-8"'
+        if self.options.get('compress', True):
+            headers["Accept-Encoding"] = ACCEPT_ENCODING
 
         log.debug('url: %s' % url)
         log.debug('sending: %s' % data)
 
-        if data:
-            http_request.send(data)
-
-        response = http_request.getresponse()
-        r = response.read()
-
+        transport = self.options.get('transport') or get_pool(
+            self.request_host, secure=self.options.get('secure', True))
+        scheduler = self.options.get('scheduler') or default_scheduler
+
+        def send():
+            if event is not None:
+                event.attempts += 1
+            return transport.request(method, url, data, headers, event)
+
+        started = time.perf_counter()
+        try:
+            response, r = scheduler.send(method, send)
+            if event is not None:
+                event.status = response.status
+                event.bytes_out = len(data) if data else 0
+            return self._response(response, r)
+        except Exception as e:
+            if event is not None:
+                event.error = e
+            raise
+        finally:
+            if event is not None:
+                event.total_time = time.perf_counter() - started
+            if own_event:
+                self._notify(event)
+
+    def _response(self, response, r):
+        """
+        Check the status of a response and return its body
+        """
         log.debug('got: %s' % r)
 
         # Unauthorized Error
@@ -275,29 +873,38 @@ class ChargifyBase(object):
         elif response.status == 422:
             raise ChargifyUnProcessableEntity()
 
+        # Rate Limited
+        elif response.status == 429:
+            raise ChargifyTooManyRequests()
+
         # Generic Server Errors
-        elif response.status in [405, 500]:
+        elif response.status == 405 or response.status >= 500:
             log.debug('response status: %s' % response.status)
             log.debug('response reason: %s' % response.reason)
             raise ChargifyServerError()
 
-        return self.fix_xml_encoding(r)
+        return r
 
     def _save(self, url, node_name):
         """
         Save the object using the passed URL as the API end point
         """
-        dom = minidom.Document()
-        dom.appendChild(self._toxml(dom))
+        if self.format == 'json':
+            data = _json_dumps({self.__xmlnodename__: self._todict()})
+        else:
+            data = self._toxml()
 
+        # updated_at is decoded in UTC
+        today = datetime.datetime.now(iso8601.UTC)
         request_made = {
-            'day': datetime.datetime.today().day,
-            'month': datetime.datetime.today().month,
-            'year': datetime.datetime.today().year
+            'day': today.day,
+            'month': today.month,
+            'year': today.year
         }
         if self.id not in [None, 'None']:
             id = str(self.id)
-            obj = self._applyS(self._put('/' + url + '/' + id + '.xml', dom.toxml(encoding="utf-8")), self.__name__, node_name)
+            obj = self._fetchS('PUT', '/%s/%s.%s' % (url, id, self.format),
+                self.__name__, node_name, data)
             if obj:
                 if type(obj.updated_at) == datetime.datetime:
                     if (obj.updated_at.day == request_made['day']) and \
@@ -307,8 +914,8 @@ class ChargifyBase(object):
                         return (True, obj)
             return (False, obj)
         else:
-            obj = self._applyS(self._post('/' + url + '.xml',
-                dom.toxml(encoding="utf-8")), self.__name__, node_name)
+            obj = self._fetchS('POST', '/%s.%s' % (url, self.format),
+                self.__name__, node_name, data)
             if obj:
                 if type(obj.updated_at) == datetime.datetime:
                     if (obj.updated_at.day == request_made['day']) and \
@@ -318,51 +925,173 @@ class ChargifyBase(object):
             return (False, obj)
 
     def _get_auth_string(self):
-        return base64.encodestring('%s:%s' % (self.api_key, 'x'))[:-1]
+        return base64.b64encode(('%s:%s' % (self.api_key, 'x')).encode('utf-8')
+            ).decode('ascii')
 
-    def getAll(self):
-        if self.Meta.listing:
-            rv = []
-            do_paging = getattr(self.Meta, "paged", False)
-            page = 1
-            while True:
-                url = '/%s.xml' % self.Meta.listing
-                if do_paging:
-                    url += '?page=%s' % page
-                    page += 1
-                vals = self._applyA(self._get(url), self.__name__, self.__xmlnodename__)
-                rv.extend(vals)
-                if not do_paging or not vals: break
-            return rv
-        raise NotImplementedError('Subclass is missing Meta class attribute listing')
+    def _get_page(self, url, page, records=False):
+        """
+        Fetch and decode one page of a paged listing
+        """
+        return self._fetchA('GET', '%s%spage=%s' % (url,
+            '&' if '?' in url else '?', page),
+            self.__name__, self.__xmlnodename__, records=records)
+
+    def _iter_pages(self, url, start=1, records=False, stop=None):
+        """
+        Yield the decoded records of a paged listing page by page, in page
+        order, stopping at the first empty page or after page stop.
+
+        Up to the prefetch_pages option (DEFAULT_PREFETCH_PAGES) pages are
+        requested concurrently; pages past the first empty one are cancelled
+        or discarded.
+        """
+        window = self.options.get('prefetch_pages', DEFAULT_PREFETCH_PAGES)
+        if stop is None:
+            stop = float('inf')
+        if window <= 1:
+            page = start
+            while page <= stop:
+                vals = self._get_page(url, page, records)
+                if not vals:
+                    return
+                yield vals
+                page += 1
+            return
+
+        with ThreadPoolExecutor(max_workers=window) as executor:
+            pending = deque()
+            page = start
+            while page <= stop and len(pending) < window:
+                pending.append(executor.submit(self._get_page, url, page,
+                    records))
+                page += 1
+            try:
+                while pending:
+                    vals = pending.popleft().result()
+                    if not vals:
+                        return
+                    if page <= stop:
+                        pending.append(executor.submit(self._get_page, url,
+                            page, records))
+                        page += 1
+                    yield vals
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def iterPages(self, per_page=None, page=1, records=False, since=None,
+            max_pages=None):
+        """
+        Yield the listing one decoded page (a list of objects) at a time,
+        as each page arrives. per_page and the starting page only apply
+        to paged listings; other listings are returned as a single page.
+
+        With records set the pages hold compact read-only Records instead
+        of full objects; fromRecord() converts one when needed.
+
+        With since, a datetime, only the records updated at or after it are
+        listed, using Chargify's date filter; naive datetimes are taken as
+        UTC. Only paged listings can be filtered.
+
+        max_pages stops the listing after that many pages; no page past
+        them is requested.
+        """
+        if not self.Meta.listing:
+            raise NotImplementedError('Subclass is missing Meta class attribute listing')
+        url = '/%s.%s' % (self.Meta.listing, self.format)
+        if not getattr(self.Meta, "paged", False):
+            if since is not None:
+                raise NotImplementedError(
+                    '%s listing has no date filter' % self.Meta.listing)
+            vals = self._fetchA('GET', url, self.__name__,
+                self.__xmlnodename__, records=records)
+            if vals:
+                yield vals
+            return
+        query = []
+        if per_page is not None:
+            query.append(('per_page', per_page))
+        if since is not None:
+            # with its offset, or Chargify takes it in the site's time zone
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=iso8601.UTC)
+            query.append(('date_field', 'updated_at'))
+            query.append(('start_datetime', since.astimezone(iso8601.UTC
+                ).replace(microsecond=0).isoformat(' ')))
+        if query:
+            url += '?' + urlencode(query)
+        stop = page + max_pages - 1 if max_pages is not None else None
+        for vals in self._iter_pages(url, page, records, stop):
+            yield vals
+
+    def iterAll(self, per_page=None, page=1, records=False, since=None):
+        """
+        Yield every object (or Record) of the listing, page by page,
+        without holding more than the pages in flight in memory
+        """
+        for vals in self.iterPages(per_page, page, records, since):
+            for val in vals:
+                yield val
+
+    def getAll(self, records=False, per_page=None, max_pages=None,
+            on_page=None, resume=None):
+        """
+        Return every object (or Record) of the listing in a list, or only
+        those of the first max_pages pages.
+
+        With on_page set nothing is collected: each decoded page is handed
+        to on_page(page, vals) as it arrives and released after, and the
+        number of the last page handed over is returned. That number is the
+        resume token: pass it as resume to continue the listing after that
+        page, e.g. once a run that stopped there is restarted.
+        """
+        start = resume + 1 if resume else 1
+        if start > 1 and not getattr(self.Meta, "paged", False):
+            # the single page of a listing without paging was handed over
+            pages = ()
+        else:
+            pages = self.iterPages(per_page, start, records,
+                max_pages=max_pages)
+        if on_page is None:
+            return list(chain.from_iterable(pages))
+        last = resume
+        for last, vals in enumerate(pages, start):
+            on_page(last, vals)
+            del vals
+        return last
 
     def getById(self, id):
         if self.Meta.listing:
-            return self._applyS(self._get('/%s/%s.xml' % (self.Meta.listing, str(id))),
-                self.__name__, self.__xmlnodename__)
+            return self._fetchS('GET', '/%s/%s.%s' % (self.Meta.listing,
+                str(id), self.format), self.__name__, self.__xmlnodename__,
+                cached=True)
         raise NotImplementedError('Subclass is missing Meta class attribute listing')
 
     def __get_by_attribute__(self, key, value):
         if self.Meta.listing:
-            return self._applyS(self._get('/%s/lookup.xml?%s=%s' %(self.Meta.listing,
-                str(key), str(value))), self.__name__, self.__xmlnodename__)
+            return self._fetchS('GET', '/%s/lookup.%s?%s=%s' %(self.Meta.listing,
+                self.format, str(key), str(value)), self.__name__,
+                self.__xmlnodename__)
         raise NotImplementedError('Subclass is missing Meta class attribute listing')
 
     def save(self):
         if self.Meta.listing:
-            return self._save(self.Meta.listing, self.__xmlnodename__)
+            try:
+                return self._save(self.Meta.listing, self.__xmlnodename__)
+            finally:
+                self.invalidateCache()
         raise NotImplementedError('Subclass is missing Meta class attribute listing')
 
 
 class CompoundKeyMixin:
     def getByCompoundKey(self, parent_id, sub_id):
         if 'compound_key' in self.Meta.__dict__.keys():
-            _cb, _a = (self._applyA, ('/%s' % self.Meta.compound_key[2])) \
-                if len(self.Meta.compound_key) == 3 else (self._applyS, '')
+            _cb, _a = (self._fetchA, ('/%s' % self.Meta.compound_key[2])) \
+                if len(self.Meta.compound_key) == 3 else (self._fetchS, '')
 
-            return _cb(self._get('/%s.xml' % ('/'.join(['%s/%s' % i
+            return _cb('GET', '/%s.%s' % ('/'.join(['%s/%s' % i
                 for i in zip(self.Meta.compound_key[:2],
-                (str(parent_id), str(sub_id)))]) + _a)),
+                (str(parent_id), str(sub_id)))]) + _a, self.format),
                     self.__name__, self.__xmlnodename__)
 
         raise NotImplementedError('Subclass is missing Meta class attribute compound key')
@@ -390,13 +1119,14 @@ class ChargifyCustomer(ChargifyBase):
     reference = ''
     created_at = None
     modified_at = None
+    updated_at = None
 
-    def __init__(self, apikey, subdomain):
-        super(ChargifyCustomer, self).__init__(apikey, subdomain)
-        self.getByReference = lambda v: self.__get_by_attribute__('reference', v)
+    def getByReference(self, reference):
+        return self.__get_by_attribute__('reference', reference)
 
     def getSubscriptions(self):
-        obj = ChargifySubscription(self.api_key, self.sub_domain)
+        obj = ChargifySubscription(self.api_key, self.sub_domain,
+            **self.options)
         return obj.getByCustomerId(self.id)
 
 
@@ -412,6 +1142,7 @@ class ChargifyProductFamily(ChargifyBase):
 
     class Meta:
         listing = 'product_families'
+        cache_ttl = 300
 
     __name__ = 'ChargifyProductFamily'
     __attribute_types__ = {}
@@ -424,7 +1155,8 @@ class ChargifyProductFamily(ChargifyBase):
     name = ''
 
     def getComponents(self):
-        obj = ChargifyProductFamilyComponent(self.api_key, self.sub_domain)
+        obj = ChargifyProductFamilyComponent(self.api_key, self.sub_domain,
+            **self.options)
         return obj.getByProductFamilyId(self.id)
 
 
@@ -435,6 +1167,7 @@ class ChargifyProductFamilyComponent(ChargifyBase):
     __xmlnodename__ = 'component'
     class Meta:
         listing = 'components'
+        cache_ttl = 300
 
     id = None
     name = ''
@@ -446,20 +1179,40 @@ class ChargifyProductFamilyComponent(ChargifyBase):
     updated_at = None
     created_at = None
 
+    def _index(self, product_family_id):
+        """
+        Return the components of a product family as an id -> Record map.
+        The map is kept in the component_index option, a cache, for the
+        cache TTL of components and dropped by invalidateCache().
+        """
+        index_cache = self.options.get('component_index')
+        key = '%s/%s' % (self.request_host, product_family_id)
+        index = None
+        if index_cache is not None:
+            index = index_cache.get(self.Meta.listing, key)
+        if index is None:
+            records = self._fetchA('GET', '/product_families/%s/components.%s' % (
+                str(product_family_id), self.format), self.__name__,
+                self.__xmlnodename__, cached=True, records=True)
+            index = dict([(str(r.id), r) for r in records])
+            ttl = self._cache_ttl()
+            if index_cache is not None and ttl:
+                index_cache.set(self.Meta.listing, key, index, ttl)
+        return index
+
+    def invalidateCache(self):
+        super(ChargifyProductFamilyComponent, self).invalidateCache()
+        index_cache = self.options.get('component_index')
+        if index_cache is not None:
+            index_cache.invalidate(self.Meta.listing)
+
     def getByProductFamilyId(self, id):
-        return self._applyA(self._get('/product_families/' + str(id) + '/components.xml'),
-            self.__name__, self.__xmlnodename__)
+        return [self.fromRecord(r) for r in self._index(id).values()]
 
     def getByIds(self, product_family_id, id):
-        result = None
-        url = '/product_families/' + str(product_family_id) + '/components.xml'
-        components = self._applyA(
-            self._get(url), self.__name__, self.__xmlnodename__)
-        if components:
-            filtered = filter(lambda c: c.id==str(id), components)
-            if len(filtered) > 0:
-                result = filtered[0]
-        return result
+        record = self._index(product_family_id).get(str(id))
+        if record is not None:
+            return self.fromRecord(record)
 
 
 class ChargifyProduct(ChargifyBase):
@@ -470,6 +1223,7 @@ class ChargifyProduct(ChargifyBase):
 
     class Meta:
         listing = 'products'
+        cache_ttl = 300
 
     __name__ = 'ChargifyProduct'
     __attribute_types__ = {
@@ -485,14 +1239,17 @@ class ChargifyProduct(ChargifyBase):
     accounting_code = ''
     interval_unit = ''
     interval = 0
+    created_at = None
+    updated_at = None
 
     def getByHandle(self, handle):
-        return self._applyS(self._get('/products/handle/' + str(handle) +
-            '.xml'), self.__name__, self.__xmlnodename__)
+        return self._fetchS('GET', '/products/handle/%s.%s' % (
+            str(handle), self.format), self.__name__, self.__xmlnodename__,
+            cached=True)
 
     def getPaymentPageUrl(self):
         return ('https://' + self.request_host + '/h/' +
-            self.id + '/subscriptions/new')
+            str(self.id) + '/subscriptions/new')
 
     def getPriceInDollars(self):
         return round(float(self.price_in_cents) / 100, 2)
@@ -526,7 +1283,7 @@ class ChargifySubscription(ChargifyBase):
     current_period_started_at = None
     current_period_ends_at = None
     trial_started_at = None
-    trial_ended_attrial_ended_at = None
+    trial_ended_at = None
     activated_at = None
     expires_at = None
     created_at = None
@@ -537,65 +1294,76 @@ class ChargifySubscription(ChargifyBase):
     product_handle = ''
     credit_card = None
     components = None
+    next_assessment_at = None
+    cancel_at_end_of_period = False
 
     def getComponents(self):
         """
         Gets the subscription components
         """
         if self.id is not None:
-            obj = ChargifySubscriptionComponent(self.api_key, self.sub_domain)
+            obj = ChargifySubscriptionComponent(self.api_key, self.sub_domain,
+            **self.options)
             return obj.getBySubscriptionId(self.id)
 
     def getComponent(self, component_id):
         """
         Gets a subscription component..
         """
-        obj = ChargifySubscriptionComponent(self.api_key, self.sub_domain)
+        obj = ChargifySubscriptionComponent(self.api_key, self.sub_domain,
+            **self.options)
         return obj.getByCompoundKey(self.id, component_id)
 
     def getByCustomerId(self, customer_id):
-        return self._applyA(self._get('/customers/' + str(customer_id) +
-            '/subscriptions.xml'), self.__name__, 'subscription')
+        return self._fetchA('GET', '/customers/%s/subscriptions.%s' % (
+            str(customer_id), self.format), self.__name__, 'subscription')
+
+    def getByCustomerIds(self, customer_ids, workers=DEFAULT_BULK_WORKERS):
+        """
+        Fetch the subscriptions of many customers, up to workers at a time
+        over the shared connection pool. Yields a (customer_id,
+        subscriptions) tuple per customer as soon as its subscriptions
+        arrive, which is not necessarily in the order of customer_ids.
+
+        A failed fetch raises its exception when its turn comes. The
+        fetches not started yet are dropped then, as they are when the
+        caller stops iterating early.
+        """
+        calls = _fan_out(self.getByCustomerId, customer_ids, workers)
+        try:
+            for customer_id, future in calls:
+                yield customer_id, future.result()
+        finally:
+            calls.close()
 
     def getBySubscriptionId(self, subscription_id):
         #Throws error if more than element is returned
-        i, = self._applyA(self._get('/subscriptions/' + str(subscription_id) +
-            '.xml'), self.__name__, 'subscription')
+        i, = self._fetchA('GET', '/subscriptions/%s.%s' % (
+            str(subscription_id), self.format), self.__name__, 'subscription')
         return i
 
     def resetBalance(self):
-        self._put("/subscriptions/" + self.id + "/reset_balance.xml", '')
+        self._put("/subscriptions/%s/reset_balance.%s" % (str(self.id),
+            self.format), '')
 
     def reactivate(self):
-        self._put("/subscriptions/" + self.id + "/reactivate.xml", "")
+        self._put("/subscriptions/%s/reactivate.%s" % (str(self.id),
+            self.format), "")
 
     def upgrade(self, toProductHandle):
-        xml = """<?xml version="1.0" encoding="UTF-8"?>
-  <subscription>
-    <product_handle>%s</product_handle>
-  </subscription>""" % (toProductHandle)
-        #end improper indentation
-
-        return self._applyS(self._put("/subscriptions/" + self.id + ".xml",
-            xml), self.__name__, "subscription")
+        data = self._payload('subscription', {'product_handle': toProductHandle})
+        return self._fetchS('PUT', "/subscriptions/%s.%s" % (str(self.id),
+            self.format), self.__name__, "subscription", data)
 
     def unsubscribe(self, message):
-        xml = """<?xml version="1.0" encoding="UTF-8"?>
-<subscription>
-  <cancellation_message>
-    %s
-  </cancellation_message>
-</subscription>""" % (message)
-
-        self._delete("/subscriptions/" + self.id + ".xml", xml)
+        data = self._payload('subscription', {'cancellation_message': message})
+        self._delete("/subscriptions/%s.%s" % (str(self.id), self.format),
+            data)
 
     def charge(self, amount, memo):
-        xml = """<?xml version="1.0" encoding="UTF-8"?>
-<charge>
-  <amount>%s</amount>
-  <memo>%s</memo>
-</charge>""" % (amount, memo)
-        self._post('/subscriptions/' + self.id + '/charges.xml', xml)
+        data = self._payload('charge', {'amount': amount, 'memo': memo})
+        self._post('/subscriptions/%s/charges.%s' % (str(self.id), self.format),
+            data)
 
 class ChargifyCreditCard(ChargifyBase):
     """
@@ -609,6 +1377,7 @@ class ChargifyCreditCard(ChargifyBase):
     last_name = ''
     full_number = ''
     masked_card_number = ''
+    card_type = ''
     expiration_month = ''
     expiration_year = ''
     cvv = ''
@@ -620,12 +1389,36 @@ class ChargifyCreditCard(ChargifyBase):
     billing_country = ''
 
     def save(self, subscription):
-        path = "/subscriptions/%s.xml" % (subscription.id)
-        data = u'<?xml version="1.0" encoding="UTF-8"?><subscription><credit_card_attributes>%s</credit_card_attributes></subscription>' % (
-                ''.join([u'<%s>%s</%s>' % (k, v, k) for (k, v) in self.__dict__.items()
-            if not k.startswith('_') and k not in self.__ignore__]))
-        return self._applyS(self._put(path, data),
-            self.__name__, "subscription")
+        path = "/subscriptions/%s.%s" % (subscription.id, self.format)
+        values = dict([(k, v) for (k, v) in self.__dict__.items()
+            if not k.startswith('_') and k not in self.__ignore__])
+        data = self._payload('subscription', {self.__xmlnodename__: values})
+        return self._fetchS('PUT', path, self.__name__, "subscription", data)
+
+
+class AllocationResult(object):
+    """
+    Outcome of one allocation update of updateAllocations(): ok is True
+    once Chargify accepted it, else error holds the exception raised.
+    component is the updated component when the response was decoded.
+    @license    GNU General Public License
+    """
+
+    __slots__ = ('subscription_id', 'component_id', 'value', 'ok', 'error',
+        'component')
+
+    def __init__(self, subscription_id, component_id, value):
+        self.subscription_id = subscription_id
+        self.component_id = component_id
+        self.value = value
+        self.ok = False
+        self.error = None
+        self.component = None
+
+    def __repr__(self):
+        return '<AllocationResult %s/%s=%r %s>' % (self.subscription_id,
+            self.component_id, self.value,
+            'ok' if self.ok else 'error: %r' % self.error)
 
 
 class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
@@ -650,9 +1443,10 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
     pricing_scheme = '' # quantity-based-component
     enabled = False # on-off-component
 
-    def _toxml(self, dom):
+    def _fields(self):
         """
-        Return a XML Representation of the object
+        Only the allocation of a quantity based or on/off component is
+        sent, and only when it is set
         """
         if self.kind == 'metered_component':
             return None
@@ -666,20 +1460,11 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
         if not value:
             return None
 
-        element = minidom.Element(self.__xmlnodename__)
-        node = minidom.Element('component_id')
-        node_txt = dom.createTextNode(str(self.component_id))
-        node.appendChild(node_txt)
-        element.appendChild(node)
-        node = minidom.Element(property)
-        node_txt = dom.createTextNode(str(value))
-        node.appendChild(node_txt)
-        element.appendChild(node)
-        return element
+        return [('component_id', self.component_id), (property, value)]
 
     def getBySubscriptionId(self, id):
-        return self._applyA(self._get('/subscriptions/' + str(id) + '/components.xml'),
-            self.__name__, self.__xmlnodename__)
+        return self._fetchA('GET', '/subscriptions/%s/components.%s' % (
+            str(id), self.format), self.__name__, self.__xmlnodename__)
 
     def updateQuantity(self, quantity):
         """
@@ -692,14 +1477,11 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
             raise ChargifyError()
 
         self.allocated_quantity = quantity
-        data = '''<?xml version="1.0" encoding="UTF-8"?><component>
-            <allocated_quantity type="integer">%d</allocated_quantity>
-          </component>''' % self.allocated_quantity
+        url, data = self._allocation(self.subscription_id, self.component_id,
+            int(self.allocated_quantity))
 
-        dom = minidom.parseString(self.fix_xml_encoding(
-        self._put('/subscriptions/%s/components/%s.xml' % (
-                str(self.subscription_id), str(self.component_id)), data)
-        ))
+        return self._fetchS('PUT', url, self.__name__, self.__xmlnodename__,
+            data)
 
     def updateOnOff(self, enable):
         """
@@ -711,15 +1493,67 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
         if self.kind != 'on_off_component':
             raise ChargifyError()
 
-        self.enabled = enabled
-        data = '''<?xml version="1.0" encoding="UTF-8"?><component>
-            <allocated_quantity>%s</allocated_quantity>
-          </component>''' % self.enabled
+        self.enabled = enable
+        url, data = self._allocation(self.subscription_id, self.component_id,
+            bool(self.enabled))
 
-        dom = minidom.parseString(self.fix_xml_encoding(
-        self._put('/subscriptions/%s/components/%s.xml' % (
-                str(self.subscription_id), str(self.component_id)), data)
-        ))
+        return self._fetchS('PUT', url, self.__name__, self.__xmlnodename__,
+            data)
+
+    def _allocation(self, subscription_id, component_id, value):
+        """
+        Return the URL and body of the PUT enabling or disabling an on/off
+        component when value is a bool, else setting the allocated
+        quantity of a quantity based component
+        """
+        if isinstance(value, bool):
+            values = {'enabled': value}
+        else:
+            values = {'allocated_quantity': int(value)}
+        return ('/subscriptions/%s/components/%s.%s' % (str(subscription_id),
+            str(component_id), self.format),
+            self._payload('component', values))
+
+    def updateAllocations(self, allocations, workers=DEFAULT_BULK_WORKERS,
+            decode=False):
+        """
+        Update many subscription components at once. allocations is an
+        iterable of (subscription_id, component_id, value) tuples, value
+        being the quantity of a quantity based component or a bool for an
+        on/off component.
+
+        Up to workers updates are sent concurrently, under the rate limit
+        and retries of the scheduler. Responses are only decoded when
+        decode is set. Returns an AllocationResult per allocation, in
+        order; a failed update does not stop the others.
+        """
+        def update(result):
+            try:
+                url, data = self._allocation(result.subscription_id,
+                    result.component_id, result.value)
+                if decode:
+                    result.component = self._fetchS('PUT', url, self.__name__,
+                        self.__xmlnodename__, data)
+                else:
+                    self._request('PUT', url, data)
+                result.ok = True
+            except Exception as e:
+                result.error = e
+            return result
+
+        results = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for allocation in allocations:
+                result = AllocationResult(*allocation)
+                results.append(result)
+                pending.append(executor.submit(update, result))
+                # keep a bounded number of updates queued
+                if len(pending) >= 2 * workers:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+        return results
 
     def getUsages(self):
         """
@@ -731,7 +1565,8 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
         if self.kind != 'metered_component':
             raise ChargifyError()
 
-        obj = ChargifyComponentUsage(self.api_key, self.sub_domain)
+        obj = ChargifyComponentUsage(self.api_key, self.sub_domain,
+            **self.options)
         return obj.getByCompoundKey(self.subscription_id, self.component_id)
 
     def createUsage(self, quantity, memo=None):
@@ -744,15 +1579,14 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
         if self.kind != 'metered_component':
             raise ChargifyError()
 
-        data = '''<?xml version="1.0" encoding="UTF-8"?><usage>
-            <quantity>%d</quantity><memo>%s</memo></usage>''' % (
-                quantity, memo or "")
+        data = self._payload('usage', {'quantity': quantity, 'memo': memo or ""})
 
-        return self._applyA(
-            self._post('/subscriptions/%s/components/%s/usages.xml' % (
-                str(self.subscription_id), str(self.component_id)), data),
+        return self._fetchA('POST',
+            '/subscriptions/%s/components/%s/usages.%s' % (
+                str(self.subscription_id), str(self.component_id),
+                self.format),
             ChargifyComponentUsage.__name__,
-            ChargifyComponentUsage.__xmlnodename__)
+            ChargifyComponentUsage.__xmlnodename__, data)
 
 
 class ChargifyComponentUsage(ChargifyBase, CompoundKeyMixin):
@@ -777,21 +1611,35 @@ class ChargifyPostBack(ChargifyBase):
     Represents Chargify API Post Backs
     @license    GNU General Public License
     """
-    subscriptions = []
-
-    def __init__(self, apikey, subdomain, postback_data):
-        ChargifyBase.__init__(apikey, subdomain)
+    def __init__(self, apikey, subdomain, postback_data,
+            workers=DEFAULT_BULK_WORKERS, **options):
+        ChargifyBase.__init__(self, apikey, subdomain, **options)
+        self.subscriptions = []
+        self.errors = {}
         if postback_data:
-            self._process_postback_data(postback_data)
+            self._process_postback_data(postback_data, workers)
 
-    def _process_postback_data(self, data):
+    def _process_postback_data(self, data, workers=DEFAULT_BULK_WORKERS):
         """
-        Process the Json array and fetches the Subscription Objects
+        Process the Json array and fetches the Subscription Objects, up to
+        workers at a time. subscriptions holds the ones fetched, in the
+        order of the postback; a subscription that could not be fetched is
+        left out and errors maps its id to the exception raised.
         """
-        csub = ChargifySubscription(self.api_key, self.sub_domain)
+        csub = ChargifySubscription(self.api_key, self.sub_domain,
+            **self.options)
         postdata_objects = json.loads(data)
-        for obj in postdata_objects:
-            self.subscriptions.append(csub.getBySubscriptionId(obj))
+        fetched = {}
+        for id, future in _fan_out(csub.getBySubscriptionId,
+                list(dict.fromkeys(postdata_objects)), workers):
+            try:
+                fetched[id] = future.result()
+            except Exception as e:
+                log.error('postback: fetching subscription %s failed: %r' % (
+                    id, e))
+                self.errors[id] = e
+        self.subscriptions = [fetched[id] for id in postdata_objects
+            if id in fetched]
 
 
 class Chargify:
@@ -802,66 +1650,114 @@ class Chargify:
     api_key = ''
     sub_domain = ''
 
-    def __init__(self, apikey, subdomain):
+    def __init__(self, apikey, subdomain, pool_size=None,
+            pool_idle_timeout=None, pool_timeout=None, **options):
+        """
+        Connections are pooled per subdomain and shared by every Chargify
+        instance; pool_size, pool_idle_timeout and pool_timeout, the
+        seconds a request may wait on a silent connection (30 by default),
+        reconfigure that pool.
+        Any other options, such as format='json', are passed on to the
+        objects created here.
+
+        Requests from this instance share one RequestScheduler, by default
+        retrying transient failures without a rate limit; pass
+        scheduler=RequestScheduler(rate=..., retries=...) to tune it.
+        Product family components are looked up through an index kept in
+        a LocalCache unless another cache is passed as component_index.
+        Pass singleflight=SingleFlight() from the singleflight module to
+        coalesce identical GETs sent concurrently into one. A GET joining a
+        flight that started before the caller's own change may get the data
+        from before it, so leave it off where reads must follow writes.
+
+        Pass observers=[...] to be told about every request sent, e.g. a
+        RequestStats from the instrumentation module, and transport=... to
+        send the requests some other way than over the connection pool,
+        e.g. to record them with a RecordingTransport from the transport
+        module or play them back with a ReplayTransport.
+        """
         self.api_key = apikey
         self.sub_domain = subdomain
+        self.options = options
+        self.options.setdefault('scheduler', RequestScheduler())
+        self.options.setdefault('component_index', LocalCache())
+        if pool_size is not None or pool_idle_timeout is not None or \
+                pool_timeout is not None:
+            get_pool(self.sub_domain + options.get('base_host',
+                ChargifyBase.base_host), pool_size, pool_idle_timeout,
+                options.get('secure', True), pool_timeout)
 
     def Customer(self):
-        return ChargifyCustomer(self.api_key, self.sub_domain)
+        return ChargifyCustomer(self.api_key, self.sub_domain,
+            **self.options)
 
     def CustomerAttributes(self):
-        return CustomerAttributes(self.api_key, self.sub_domain)
+        return CustomerAttributes(self.api_key, self.sub_domain,
+            **self.options)
 
     def Product(self):
-        return ChargifyProduct(self.api_key, self.sub_domain)
+        return ChargifyProduct(self.api_key, self.sub_domain,
+            **self.options)
 
     def Component(self):
-        return ChargifyProductFamilyComponent(self.api_key,
-            self.sub_domain)
+        return ChargifyProductFamilyComponent(self.api_key, self.sub_domain,
+            **self.options)
 
     def ProductFamily(self):
-        return ChargifyProductFamily(self.api_key, self.sub_domain)
+        return ChargifyProductFamily(self.api_key, self.sub_domain,
+            **self.options)
 
     def Subscription(self):
-        return ChargifySubscription(self.api_key, self.sub_domain)
+        return ChargifySubscription(self.api_key, self.sub_domain,
+            **self.options)
 
     def SubscriptionComponent(self):
-        return ChargifySubscriptionComponent(self.api_key,
-            self.sub_domain)
+        return ChargifySubscriptionComponent(self.api_key, self.sub_domain,
+            **self.options)
 
     def ComponentUsage(self):
-        return ChargifyComponentUsage(self.api_key, self.sub_domain)
+        return ChargifyComponentUsage(self.api_key, self.sub_domain,
+            **self.options)
 
     def CreditCard(self):
-        return ChargifyCreditCard(self.api_key, self.sub_domain)
+        return ChargifyCreditCard(self.api_key, self.sub_domain,
+            **self.options)
 
-    def PostBack(self, postbackdata):
-        return ChargifyPostBack(self.api_key, self.sub_domain, postbackdata)
+    def PostBack(self, postbackdata, workers=DEFAULT_BULK_WORKERS):
+        return ChargifyPostBack(self.api_key, self.sub_domain, postbackdata,
+            workers, **self.options)
 
     @property
     def Customers(self):
-        return ChargifyCustomer(self.api_key, self.sub_domain)
+        return ChargifyCustomer(self.api_key, self.sub_domain,
+            **self.options)
 
     @property
     def Products(self):
-        return ChargifyProduct(self.api_key, self.sub_domain)
+        return ChargifyProduct(self.api_key, self.sub_domain,
+            **self.options)
 
     @property
     def Components(self):
-        return ChargifyProductFamilyComponent(self.api_key, self.sub_domain)
+        return ChargifyProductFamilyComponent(self.api_key, self.sub_domain,
+            **self.options)
 
     @property
     def ProductFamilies(self):
-        return ChargifyProductFamily(self.api_key, self.sub_domain)
+        return ChargifyProductFamily(self.api_key, self.sub_domain,
+            **self.options)
 
     @property
     def Subscriptions(self):
-        return ChargifySubscription(self.api_key, self.sub_domain)
+        return ChargifySubscription(self.api_key, self.sub_domain,
+            **self.options)
 
     @property
     def SubscriptionComponents(self):
-        return ChargifySubscriptionComponent(self.api_key, self.sub_domain)
+        return ChargifySubscriptionComponent(self.api_key, self.sub_domain,
+            **self.options)
 
     @property
     def ComponentUsages(self):
-        return ChargifyComponentUsage(self.api_key, self.sub_domain)
+        return ChargifyComponentUsage(self.api_key, self.sub_domain,
+            **self.options)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Response caches for rarely changing Chargify resources.
+
+Entries are grouped by resource (the Meta.listing of the class that
+fetched them, e.g. 'products') so a whole resource can be invalidated at
+once.
+'''
+
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class BaseCache(object):
+    """
+    Common interface and hit/miss accounting of the response caches
+    @license    GNU General Public License
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, value):
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def get(self, resource, key):
+        """
+        Return the cached value or None
+        """
+        raise NotImplementedError()
+
+    def set(self, resource, key, value, ttl):
+        """
+        Cache value for ttl seconds
+        """
+        raise NotImplementedError()
+
+    def invalidate(self, resource=None):
+        """
+        Drop every entry of resource, or of all resources
+        """
+        raise NotImplementedError()
+
+    def stats(self):
+        with self._stats_lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class LocalCache(BaseCache):
+    """
+    Thread-safe in-process cache, holding at most max_entries entries and
+    evicting the least recently used one first
+    @license    GNU General Public License
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        super(LocalCache, self).__init__()
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, resource, key):
+        with self._lock:
+            entry = self._entries.get((resource, key))
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end((resource, key))
+                    return self._count(entry[1])
+                del self._entries[(resource, key)]
+        return self._count(None)
+
+    def set(self, resource, key, value, ttl):
+        with self._lock:
+            self._entries[(resource, key)] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end((resource, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, resource=None):
+        with self._lock:
+            if resource is None:
+                self._entries.clear()
+            else:
+                for entry in [e for e in self._entries if e[0] == resource]:
+                    del self._entries[entry]
+
+    def stats(self):
+        stats = super(LocalCache, self).stats()
+        stats['entries'] = len(self._entries)
+        return stats
+
+
+class DjangoCache(BaseCache):
+    """
+    Cache backed by one of the caches configured in Django's CACHES
+    setting, so entries are shared between processes. Invalidation bumps
+    a per-resource generation number instead of deleting keys; size
+    bounds and eviction are left to the Django cache backend.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, alias='default', prefix='pychargify'):
+        super(DjangoCache, self).__init__()
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.prefix = prefix
+
+    def _generation_key(self, resource):
+        return '%s:generation:%s' % (self.prefix, resource or '')
+
+    def _key(self, resource, key):
+        generations = self.cache.get_many([self._generation_key(None),
+            self._generation_key(resource)])
+        return '%s:%s:%s:%s' % (self.prefix,
+            generations.get(self._generation_key(None), 0),
+            generations.get(self._generation_key(resource), 0),
+            hashlib.md5(('%s:%s' % (resource, key)).encode('utf-8')).hexdigest())
+
+    def get(self, resource, key):
+        return self._count(self.cache.get(self._key(resource, key)))
+
+    def set(self, resource, key, value, ttl):
+        self.cache.set(self._key(resource, key), value, ttl)
+
+    def invalidate(self, resource=None):
+        key = self._generation_key(resource)
+        self.cache.add(key, 0, None)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, 1, None)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Keep-alive connection pooling for the Chargify API.
+'''
+
+import http.client
+import logging
+import select
+import threading
+import time
+import zlib
+
+from collections import deque
+
+from .scheduler import IDEMPOTENT_METHODS
+
+log = logging.getLogger("pychargify")
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 60
+
+# Seconds to wait for a connection, or for the server to send anything,
+# before giving up on the request
+DEFAULT_TIMEOUT = 30
+
+# Content codings the responses are decompressed from
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# Number of bytes read from the socket at a time
+READ_CHUNK_SIZE = 65536
+
+# Errors raised when the server has silently dropped a kept-alive
+# connection: while sending the request, or when no status line came back
+SEND_ERRORS = (ConnectionError,)
+NO_RESPONSE_ERRORS = (http.client.BadStatusLine,)
+
+
+def is_dropped(connection):
+    """
+    Whether the server has closed an idle connection: its socket is
+    readable, at end of file or with unexpected data, before anything
+    was sent
+    """
+    if connection.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def _inflate(decompressor, chunk, data):
+    """
+    Decompress chunk onto the end of data, a READ_CHUNK_SIZE piece at a
+    time so no piece is ever close to the size of the body
+    """
+    while chunk:
+        data += decompressor.decompress(chunk, READ_CHUNK_SIZE)
+        chunk = decompressor.unconsumed_tail
+
+
+def read_body(response):
+    """
+    Read the body of a response, decompressing a gzip or deflate coded one
+    a chunk at a time as it arrives. Returns a (data, wire_size) tuple,
+    wire_size being the number of bytes received. A decompressed body is
+    grown in place in a bytearray, so it is only held once at full size.
+    """
+    encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+    if encoding not in ('gzip', 'x-gzip', 'deflate'):
+        data = response.read()
+        return data, len(data)
+
+    # 32 + MAX_WBITS accepts both the gzip and the zlib wrapper
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    data = bytearray()
+    wire_size = 0
+    while True:
+        chunk = response.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        try:
+            _inflate(decompressor, chunk, data)
+        except zlib.error:
+            # some servers send raw deflate data without the zlib wrapper
+            if wire_size or encoding != 'deflate':
+                raise
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            del data[:]
+            _inflate(decompressor, chunk, data)
+        wire_size += len(chunk)
+    data += decompressor.flush()
+    return data, wire_size
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of persistent HTTPS (or, when secure is False,
+    plain HTTP) connections to a single host.
+
+    At most `size` connections are open at any time; callers block until
+    one is released. Connections idle for longer than `idle_timeout`
+    seconds are closed instead of being reused. A request whose connection
+    stays silent for `timeout` seconds fails with TimeoutError, so a
+    stalled socket does not hold on to its place in the pool.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, host, size=DEFAULT_POOL_SIZE,
+            idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=DEFAULT_TIMEOUT,
+            secure=True):
+        self.host = host
+        self.secure = secure
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = deque()
+        self._in_use = 0
+        self._lock = threading.Condition()
+
+    def _connect(self):
+        """
+        Open a new connection to the host
+        """
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _evict(self):
+        """
+        Close connections that have been idle for too long. Must be called
+        with the lock held.
+        """
+        deadline = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < deadline:
+            connection, last_used = self._idle.popleft()
+            connection.close()
+
+    def acquire(self):
+        """
+        Check a connection out of the pool, returns a (connection, reused)
+        tuple
+        """
+        with self._lock:
+            while True:
+                self._evict()
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    self._in_use += 1
+                    return connection, True
+                if self._in_use + len(self._idle) < self.size:
+                    self._in_use += 1
+                    break
+                self._lock.wait()
+        return self._connect(), False
+
+    def release(self, connection, reusable=True):
+        """
+        Return a connection to the pool, closing it if it can not be reused
+        """
+        with self._lock:
+            self._in_use -= 1
+            if reusable and self._in_use + len(self._idle) < self.size:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                connection.close()
+            self._lock.notify()
+
+    def configure(self, size=None, idle_timeout=None, timeout=None):
+        """
+        Change the pool size, the idle timeout and/or the request timeout
+        of a live pool; a new timeout applies to the idle connections too
+        """
+        with self._lock:
+            if size is not None:
+                self.size = size
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+            if timeout is not None:
+                self.timeout = timeout
+                for connection, last_used in self._idle:
+                    connection.timeout = timeout
+                    if connection.sock is not None:
+                        connection.sock.settimeout(timeout)
+            self._lock.notify_all()
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.popleft()
+                connection.close()
+
+    def request(self, method, url, body=None, headers=None, event=None):
+        """
+        Send a request over a pooled connection and return a
+        (response, data) tuple once the response body has been read.
+
+        Idle connections the server has closed are discarded before use. A
+        kept-alive connection that still turns out to be stale is discarded
+        and the request is sent once more over a fresh connection, but only
+        when it could not have been processed: sending it failed, or, for an
+        idempotent method, the connection closed without a status line.
+        Nothing is sent again once the response has started to arrive.
+
+        Compressed responses are decompressed, see read_body().
+
+        If an event is passed its connect_time (0 for a reused connection),
+        ttfb (time from sending the request to the response headers) and
+        bytes_in (bytes received for the body) attributes are set.
+        """
+        while True:
+            connection, reused = self.acquire()
+            if reused and is_dropped(connection):
+                connection.close()
+                reused = False
+            resend = False
+            try:
+                started = time.perf_counter()
+                if not reused:
+                    connection.connect()
+                connected = time.perf_counter()
+                try:
+                    connection.request(method, url, body, headers or {})
+                except SEND_ERRORS:
+                    resend = reused
+                    raise
+                try:
+                    response = connection.getresponse()
+                except NO_RESPONSE_ERRORS:
+                    resend = reused and method in IDEMPOTENT_METHODS
+                    raise
+                if event is not None:
+                    event.connect_time = connected - started
+                    event.ttfb = time.perf_counter() - connected
+                data, wire_size = read_body(response)
+                if event is not None:
+                    event.bytes_in = wire_size
+            except SEND_ERRORS + NO_RESPONSE_ERRORS:
+                self.release(connection, False)
+                if not resend:
+                    raise
+                log.debug('stale connection to %s, reconnecting' % self.host)
+                continue
+            except:
+                self.release(connection, False)
+                raise
+            self.release(connection, not response.will_close)
+            return response, data
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, size=None, idle_timeout=None, secure=True, timeout=None):
+    """
+    Return the connection pool shared by every client of `host`, creating
+    it on first use. Passing `size`, `idle_timeout` or `timeout`
+    reconfigures it.
+    """
+    with _pools_lock:
+        pool = _pools.get((host, secure))
+        if pool is None:
+            pool = _pools[(host, secure)] = ConnectionPool(host,
+                size or DEFAULT_POOL_SIZE, idle_timeout or DEFAULT_IDLE_TIMEOUT,
+                timeout or DEFAULT_TIMEOUT, secure=secure)
+            return pool
+    if size is not None or idle_timeout is not None or timeout is not None:
+        pool.configure(size, idle_timeout, timeout)
+    return pool
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Request instrumentation for the Chargify API.
+
+Observers are passed to Chargify() as observers=[...]; each one is an
+object with an observe(event) method called with a RequestEvent once a
+request has been sent and its response decoded.
+'''
+
+import bisect
+import re
+import threading
+
+_ID_RX = re.compile(r'/\d+(?=[/.]|$)')
+_HANDLE_RX = re.compile(r'/handle/[^/]+?(?=\.\w+$|$)')
+
+
+def url_template(url):
+    """
+    Normalize a request URL for aggregation: numeric ids and product
+    handles are replaced by placeholders and the query string is dropped,
+    e.g. /subscriptions/123/components/4.xml?x=1 becomes
+    /subscriptions/:id/components/:id.xml
+    """
+    path = url.split('?', 1)[0]
+    return _HANDLE_RX.sub('/handle/:handle', _ID_RX.sub('/:id', path))
+
+
+class RequestEvent(object):
+    """
+    Everything measured about one API request. Times are in seconds and
+    None when they were not measured, e.g. parse_time for responses that
+    are not decoded.
+    @license    GNU General Public License
+    """
+
+    __slots__ = ('method', 'url', 'template', 'status', 'bytes_out',
+        'bytes_in', 'connect_time', 'ttfb', 'total_time', 'parse_time',
+        'attempts', 'error')
+
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+        self.template = url_template(url)
+        self.status = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.connect_time = None
+        self.ttfb = None
+        self.total_time = None
+        self.parse_time = None
+        self.attempts = 0
+        self.error = None
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram of durations in seconds
+    @license    GNU General Public License
+    """
+
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2,
+        5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class EndpointStats(object):
+    """
+    Aggregated measurements of one (method, url template) pair
+    @license    GNU General Public License
+    """
+
+    TIMINGS = ('total_time', 'connect_time', 'ttfb', 'parse_time')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.timings = dict([(name, Histogram()) for name in self.TIMINGS])
+
+    def add(self, event):
+        self.requests += 1
+        if event.error is not None or (event.status or 0) >= 400:
+            self.errors += 1
+        self.retries += max(0, event.attempts - 1)
+        self.bytes_out += event.bytes_out
+        self.bytes_in += event.bytes_in
+        for name in self.TIMINGS:
+            value = getattr(event, name)
+            if value is not None:
+                self.timings[name].add(value)
+
+
+class RequestStats(object):
+    """
+    Thread-safe in-memory observer aggregating requests per endpoint
+    @license    GNU General Public License
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def observe(self, event):
+        with self._lock:
+            key = (event.method, event.template)
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = EndpointStats()
+            stats.add(event)
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+
+    def dump(self):
+        """
+        Return a text report, slowest endpoints (by total time) first
+        """
+        def ms(value):
+            return '-' if value is None else '%.1f' % (value * 1000)
+
+        lines = ['%-6s %-45s %6s %5s %5s %9s %9s %8s %8s %8s %8s %8s' % (
+            'method', 'endpoint', 'count', 'err', 'retry', 'KB out', 'KB in',
+            'mean ms', 'p50 ms', 'p99 ms', 'ttfb ms', 'parse ms')]
+        with self._lock:
+            endpoints = sorted(self.endpoints.items(),
+                key=lambda item: -item[1].timings['total_time'].total)
+            for (method, template), stats in endpoints:
+                total = stats.timings['total_time']
+                lines.append('%-6s %-45s %6d %5d %5d %9.1f %9.1f %8s %8s %8s %8s %8s' % (
+                    method, template, stats.requests, stats.errors,
+                    stats.retries, stats.bytes_out / 1024.0,
+                    stats.bytes_in / 1024.0, ms(total.mean),
+                    ms(total.percentile(50)), ms(total.percentile(99)),
+                    ms(stats.timings['ttfb'].mean),
+                    ms(stats.timings['parse_time'].mean)))
+        return '\n'.join(lines)
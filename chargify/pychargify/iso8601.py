@@ -6,32 +6,71 @@ the W3C profile, but all accepted date/time values are legal ISO 8601 dates.
 The tostring() method only generates formatted dates that are conformant to
 the profile.
 
+parse_datetime() returns timezone aware UTC datetimes, parsing the
+YYYY-MM-DDTHH:MM:SS+HH:MM form used by Chargify with datetime.fromisoformat()
+rather than the regular expression and remembering recently parsed values.
+
 This module was written by Fred L. Drake, Jr. <fdrake@acm.org>.
 """
 
-__version__ = '1.0'
+__version__ = '1.1'
 
+import datetime
 import time
 
+from functools import lru_cache
+
+UTC = datetime.timezone.utc
+
+# Number of distinct date/time strings parse_datetime() remembers
+PARSE_CACHE_SIZE = 4096
+
 
 def parse(s):
     """Parse an ISO-8601 date/time string, returning the value in seconds
     since the epoch."""
     m = __datetime_rx.match(s)
     if m is None or m.group() != s:
-        raise ValueError, "unknown or illegal ISO-8601 date format: " + `s`
+        raise ValueError("unknown or illegal ISO-8601 date format: " + repr(s))
     gmt = __extract_date(m) + __extract_time(m) + (0, 0, 0)
     return time.mktime(gmt) + __extract_tzd(m) - time.timezone
 
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_datetime(s):
+    """Parse an ISO-8601 date/time string, returning an aware datetime in
+    UTC."""
+    # Fast path: datetime's own parser handles the full date/time with
+    # offset form Chargify sends
+    try:
+        value = datetime.datetime.fromisoformat(s)
+    except ValueError:
+        pass
+    else:
+        if value.tzinfo is not None:
+            return value.astimezone(UTC)
+    m = __datetime_rx.match(s)
+    if m is None or m.group() != s:
+        raise ValueError("unknown or illegal ISO-8601 date format: " + repr(s))
+    year, month, day = __extract_date(m)
+    hours, minutes, seconds = __extract_time(m)
+    fraction = m.group("seconds")
+    microseconds = 0
+    if fraction and fraction[2:]:
+        microseconds = int(round(float("0." + fraction[3:]) * 1000000))
+    return datetime.datetime(year, month, day, hours, minutes, seconds,
+        tzinfo=UTC) + datetime.timedelta(seconds=__extract_tzd(m),
+        microseconds=microseconds)
+
+
 def parse_timezone(timezone):
     """Parse an ISO-8601 time zone designator, returning the value in seconds
     relative to UTC."""
     m = __tzd_rx.match(timezone)
     if not m:
-        raise ValueError, "unknown timezone specifier: " + `timezone`
+        raise ValueError("unknown timezone specifier: " + repr(timezone))
     if m.group() != timezone:
-        raise ValueError, "unknown timezone specifier: " + `timezone`
+        raise ValueError("unknown timezone specifier: " + repr(timezone))
     return __extract_tzd(m)
 
 
@@ -44,15 +83,15 @@ def tostring(t, timezone=0):
     Some effort is made to avoid adding text for the 'seconds' field, but
     seconds are supported to the hundredths.
     """
-    if type(timezone) is type(''):
+    if isinstance(timezone, str):
         timezone = parse_timezone(timezone)
     else:
         timezone = int(timezone)
     if timezone:
         sign = (timezone < 0) and "+" or "-"
         timezone = abs(timezone)
-        hours = timezone / (60 * 60)
-        minutes = (timezone % (60 * 60)) / 60
+        hours = timezone // (60 * 60)
+        minutes = (timezone % (60 * 60)) // 60
         tzspecifier = "%c%02d:%02d" % (sign, hours, minutes)
     else:
         tzspecifier = "Z"
@@ -82,14 +121,14 @@ def ctime(t):
 
 import re
 
-__date_re = ("(?P<year>\d\d\d\d)"
-             "(?:(?P<dsep>-|)"
-                "(?:(?P<julian>\d\d\d)"
-                  "|(?P<month>\d\d)(?:(?P=dsep)(?P<day>\d\d))?))?")
-__tzd_re = "(?P<tzd>[-+](?P<tzdhours>\d\d)(?::?(?P<tzdminutes>\d\d))|Z)"
+__date_re = (r"(?P<year>\d\d\d\d)"
+             r"(?:(?P<dsep>-|)"
+                r"(?:(?P<julian>\d\d\d)"
+                  r"|(?P<month>\d\d)(?:(?P=dsep)(?P<day>\d\d))?))?")
+__tzd_re = r"(?P<tzd>[-+](?P<tzdhours>\d\d)(?::?(?P<tzdminutes>\d\d))|Z)"
 __tzd_rx = re.compile(__tzd_re)
-__time_re = ("(?P<hours>\d\d)(?P<tsep>:|)(?P<minutes>\d\d)"
-             "(?:(?P=tsep)(?P<seconds>\d\d(?:[.,]\d+)?))?"
+__time_re = (r"(?P<hours>\d\d)(?P<tsep>:|)(?P<minutes>\d\d)"
+             r"(?:(?P=tsep)(?P<seconds>\d\d(?:[.,]\d+)?))?"
              + __tzd_re)
 
 __datetime_re = "%s(?:T%s)?" % (__date_re, __time_re)
@@ -110,13 +149,13 @@ def __extract_date(m):
     else:
         month = int(month)
         if not 1 <= month <= 12:
-            raise ValueError, "illegal month number: " + m.group("month")
+            raise ValueError("illegal month number: " + m.group("month"))
         else:
             day = m.group("day")
             if day:
                 day = int(day)
                 if not 1 <= day <= 31:
-                    raise ValueError, "illegal day number: " + m.group("day")
+                    raise ValueError("illegal day number: " + m.group("day"))
             else:
                 day = 1
     return year, month, day
@@ -130,17 +169,16 @@ def __extract_time(m):
         return 0, 0, 0
     hours = int(hours)
     if not 0 <= hours <= 23:
-        raise ValueError, "illegal hour number: " + m.group("hours")
+        raise ValueError("illegal hour number: " + m.group("hours"))
     minutes = int(m.group("minutes"))
     if not 0 <= minutes <= 59:
-        raise ValueError, "illegal minutes number: " + m.group("minutes")
+        raise ValueError("illegal minutes number: " + m.group("minutes"))
     seconds = m.group("seconds")
     if seconds:
-        seconds = float(seconds)
+        seconds = float(seconds.replace(",", "."))
         if not 0 <= seconds <= 60:
-            raise ValueError, "illegal seconds number: " + m.group("seconds")
-        # Python 2.3 requires seconds to be an integer
-        seconds=int(seconds)
+            raise ValueError("illegal seconds number: " + m.group("seconds"))
+        seconds = int(seconds)
     else:
         seconds = 0
     return hours, minutes, seconds
@@ -168,7 +206,7 @@ def __extract_tzd(m):
 
 
 def __find_julian(year, julian):
-    month = julian / 30 + 1
+    month = julian // 30 + 1
     day = julian % 30 + 1
     jday = None
     while jday != julian:
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Compact read-only records for decoded Chargify objects.
+
+A record keeps the values of one decoded object in __slots__ and nothing
+else: no credentials, no options and no methods talking to the API. Use
+ChargifyBase.fromRecord() to turn one back into a full object.
+'''
+
+
+class Record(object):
+    """
+    Read-only snapshot of a decoded object. Fields declared on the object
+    class live in slots and read as the class default when the response
+    did not carry them; any other field is kept in a dict that only
+    exists when there are such fields.
+    @license    GNU General Public License
+    """
+
+    __slots__ = ('_extra',)
+
+    # Set on the subclasses by record_type()
+    _object_type = None
+    _fields = ()
+    _defaults = {}
+
+    def __init__(self, values):
+        set = object.__setattr__
+        defaults = self._defaults
+        extra = None
+        for name, value in values.items():
+            if name in defaults:
+                set(self, name, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[name] = value
+        if extra is not None:
+            set(self, '_extra', extra)
+
+    def __getattr__(self, name):
+        # only called for unset slots and names that are not slots
+        if name == '_extra':
+            return None
+        try:
+            return self._defaults[name]
+        except KeyError:
+            pass
+        extra = self._extra
+        if extra is not None and name in extra:
+            return extra[name]
+        raise AttributeError('%s has no field %r' % (type(self).__name__, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __reduce__(self):
+        return (_restore, (self._object_type, dict(self.items())))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+            dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(['%s=%r' % item
+            for item in self.items()]))
+
+    def items(self):
+        """
+        Return the (name, value) pairs of the fields the response carried
+        """
+        get = object.__getattribute__
+        items = []
+        for name in self._fields:
+            try:
+                items.append((name, get(self, name)))
+            except AttributeError:
+                pass
+        if self._extra:
+            items.extend(self._extra.items())
+        return items
+
+
+def _restore(object_type, values):
+    """
+    Unpickle a record; record classes are created at runtime so they are
+    found through their object class
+    """
+    from . import api
+    return getattr(api, object_type)._record_type()(values)
+
+
+def record_type(name, object_type, defaults):
+    """
+    Create the record class of the object class named object_type, with a
+    slot for every field in defaults, a {name: default value} dict
+    """
+    fields = tuple(defaults)
+    return type(name, (Record,), {
+        '__slots__': fields,
+        '_object_type': object_type,
+        '_fields': fields,
+        '_defaults': dict(defaults),
+    })
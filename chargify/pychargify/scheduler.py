@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Request scheduling for the Chargify API: rate limiting and retries.
+'''
+
+import email.utils
+import http.client
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger("pychargify")
+
+# Methods that can safely be sent again after a server error or a
+# dropped connection
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# Rate limited responses are retried whatever the method, the request
+# was not processed
+RATE_LIMITED_STATUS = 429
+RETRY_STATUSES = (500, 502, 503, 504)
+RETRY_ERRORS = (ConnectionError, TimeoutError, http.client.HTTPException)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing `rate` requests per second on
+    average with bursts of up to `burst` requests
+    @license    GNU General Public License
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available. Tokens are reserved
+        in arrival order so concurrent callers are served fairly.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RequestScheduler(object):
+    """
+    Sends requests under an optional rate limit and retries the ones that
+    failed transiently: rate limited (429) responses, server errors and
+    dropped connections, the latter two for idempotent methods only.
+
+    Retries wait for the Retry-After the server asked for, or else for an
+    exponential backoff with full jitter: a random delay between 0 and
+    min(max_backoff, backoff * 2 ** attempt) seconds. A Retry-After also
+    holds back every other request sent through the scheduler. One longer
+    than max_backoff is not waited for: the response is returned as is,
+    so a 429 raises ChargifyTooManyRequests.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, rate=None, burst=None, retries=3, backoff=0.5,
+            max_backoff=30):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._resume_at = 0
+
+    def _wait(self):
+        """
+        Block until the scheduler lets the next request through
+        """
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff,
+            self.backoff * 2 ** attempt))
+
+    def _retry_after(self, response):
+        """
+        Seconds to wait according to the Retry-After header, if any
+        """
+        value = response.getheader('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0, email.utils.parsedate_to_datetime(value).timestamp()
+                - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def send(self, method, request):
+        """
+        Call request(), which sends the request and returns a
+        (response, data) tuple, retrying it as needed
+        """
+        attempt = 0
+        while True:
+            self._wait()
+            try:
+                response, data = request()
+            except RETRY_ERRORS as e:
+                if attempt >= self.retries or method not in IDEMPOTENT_METHODS:
+                    raise
+                delay = self._backoff(attempt)
+                log.debug('%s failed with %r, retrying in %.2fs' % (method,
+                    e, delay))
+            else:
+                if attempt >= self.retries or not (
+                        response.status == RATE_LIMITED_STATUS or
+                        (response.status in RETRY_STATUSES and
+                            method in IDEMPOTENT_METHODS)):
+                    return response, data
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                elif delay > self.max_backoff:
+                    log.debug('%s got status %s, not retrying in %.0fs' % (
+                        method, response.status, delay))
+                    return response, data
+                else:
+                    self._resume_at = max(self._resume_at,
+                        time.monotonic() + delay)
+                log.debug('%s got status %s, retrying in %.2fs' % (method,
+                    response.status, delay))
+            attempt += 1
+            time.sleep(delay)
+
+
+default_scheduler = RequestScheduler()
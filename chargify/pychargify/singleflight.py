@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Coalescing of identical concurrent requests.
+
+The first thread to ask for a key leads a flight and does the work; the
+threads asking for the same key while it is in flight wait for the leader
+and share its result instead of repeating the work.
+'''
+
+import threading
+
+
+class Flight(object):
+    """
+    One in-flight call, created by SingleFlight.join()
+    @license    GNU General Public License
+    """
+
+    __slots__ = ('group', 'key', 'waiters', 'result', 'error', '_done')
+
+    def __init__(self, group, key):
+        self.group = group
+        self.key = key
+        self.waiters = 0
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def _close(self):
+        # must be called with the group lock held
+        if self.group._flights.get(self.key) is self:
+            del self.group._flights[self.key]
+
+    def detach(self):
+        """
+        Stop new callers from joining the flight; returns True when nobody
+        joined it, so the leader can keep its result to itself
+        """
+        with self.group._lock:
+            self._close()
+            return self.waiters == 0
+
+    def finish(self, result=None, error=None):
+        """
+        Hand the result, or the exception raised, to the waiting callers
+        """
+        with self.group._lock:
+            self._close()
+            self.result = result
+            self.error = error
+        self._done.set()
+
+    def wait(self):
+        """
+        Wait for the leader and return its result, or raise its exception
+        """
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight(object):
+    """
+    Thread-safe group of flights keyed by request. calls counts the calls
+    that joined the group and saved the ones that shared the result of
+    another call instead of making their own.
+    @license    GNU General Public License
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.saved = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """
+        Return a (flight, leader) tuple: the flight in progress for key and
+        False, or a new flight to lead and True
+        """
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self.saved += 1
+                return flight, False
+            flight = self._flights[key] = Flight(self, key)
+            return flight, True
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'saved': self.saved,
+                'in_flight': len(self._flights)}
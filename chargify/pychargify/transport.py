@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Pluggable transports for the Chargify API.
+
+A transport sends a request and returns a (response, data) tuple, data
+being the decompressed body; the connection pools of the connection
+module are the default transport. Pass another one as the transport
+option to record the requests made to a cassette file, or to serve them
+back from one without a network.
+
+A cassette is a header line followed by one entry per request: a 4 byte
+big-endian length, that many bytes of JSON describing the request and
+the response, and the response body as it was received.
+'''
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+from .connection import get_pool
+
+CASSETTE_HEADER = b'pychargify cassette 1\n'
+
+_LENGTH = struct.Struct('>I')
+
+
+class CassetteError(Exception):
+    """
+    A cassette is unreadable, or holds no response for a request
+    @license    GNU General Public License
+    """
+
+
+def _body_digest(body):
+    if body is None:
+        body = b''
+    elif isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha1(body).hexdigest()
+
+
+class BaseTransport(object):
+    """
+    Sends requests to Chargify
+    @license    GNU General Public License
+    """
+
+    def request(self, method, url, body=None, headers=None, event=None):
+        """
+        Send a request and return a (response, data) tuple, see
+        ConnectionPool.request()
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class RecordingTransport(BaseTransport):
+    """
+    Sends requests through another transport and appends every request
+    and its response to the cassette at path. Without a transport the
+    requests go through the shared connection pool of their Host.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, path, transport=None, secure=True):
+        self.path = path
+        self.transport = transport
+        self.secure = secure
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(CASSETTE_HEADER)
+            self._file.flush()
+
+    def request(self, method, url, body=None, headers=None, event=None):
+        transport = self.transport
+        if transport is None:
+            transport = get_pool((headers or {})['Host'], secure=self.secure)
+        response, data = transport.request(method, url, body, headers, event)
+        meta = json.dumps({
+            'method': method,
+            'url': url,
+            'body': _body_digest(body),
+            'status': response.status,
+            'reason': response.reason,
+            'headers': response.getheaders(),
+            'wire_size': event.bytes_in if event is not None else len(data),
+            'length': len(data),
+        }, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            self._file.write(_LENGTH.pack(len(meta)))
+            self._file.write(meta)
+            self._file.write(data)
+            self._file.flush()
+        return response, data
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ReplayResponse(object):
+    """
+    A recorded response
+    @license    GNU General Public License
+    """
+
+    __slots__ = ('status', 'reason', 'headers', 'will_close')
+
+    def __init__(self, status, reason, headers):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.will_close = False
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def getheaders(self):
+        return list(self.headers)
+
+
+class ReplayTransport(BaseTransport):
+    """
+    Serves the responses recorded in the cassette at path, matching
+    requests on their method, URL and, when match_body is set, body.
+
+    The cassette is memory-mapped and only its index is read up front;
+    bodies are copied out of the map as they are served. Requests made
+    more often than they were recorded get the last of their responses
+    again; a request never recorded raises CassetteError.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, path, match_body=True):
+        self.path = path
+        self.match_body = match_body
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._served = {}
+        self._index = {}
+        with open(path, 'rb') as cassette:
+            if os.fstat(cassette.fileno()).st_size <= len(CASSETTE_HEADER):
+                raise CassetteError('%s holds no requests' % path)
+            self._map = mmap.mmap(cassette.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        if self._map[:len(CASSETTE_HEADER)] != CASSETTE_HEADER:
+            self._map.close()
+            raise CassetteError('%s is not a cassette' % path)
+        self._read_index()
+
+    def _key(self, method, url, body):
+        return (method, url, _body_digest(body) if self.match_body else None)
+
+    def _read_index(self):
+        position = len(CASSETTE_HEADER)
+        size = len(self._map)
+        while position + _LENGTH.size <= size:
+            length, = _LENGTH.unpack_from(self._map, position)
+            position += _LENGTH.size
+            if position + length > size:
+                break
+            meta = json.loads(self._map[position:position + length])
+            position += length
+            response = ReplayResponse(meta['status'], meta['reason'],
+                [tuple(header) for header in meta['headers']])
+            key = (meta['method'], meta['url'],
+                meta['body'] if self.match_body else None)
+            self._index.setdefault(key, []).append((response, position,
+                meta['length'], meta['wire_size']))
+            position += meta['length']
+        if position != size:
+            raise CassetteError('%s is truncated' % self.path)
+
+    def request(self, method, url, body=None, headers=None, event=None):
+        key = self._key(method, url, body)
+        with self._lock:
+            entries = self._index.get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteError('no recorded response for %s %s' % (
+                    method, url))
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        response, position, length, wire_size = entries[
+            min(served, len(entries) - 1)]
+        if event is not None:
+            event.connect_time = 0
+            event.ttfb = 0
+            event.bytes_in = wire_size
+        return response, self._map[position:position + length]
+
+    def rewind(self):
+        """
+        Serve every request from its first recorded response again
+        """
+        with self._lock:
+            self._served.clear()
+
+    def close(self):
+        self._map.close()
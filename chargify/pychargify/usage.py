@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Buffered metered usage for the Chargify API.
+
+Usage is recorded per event into a store and sent to Chargify as one
+aggregated usage per (subscription, component) when the accumulator is
+flushed.
+
+Delivery is at-least-once: usage leaves the store only once Chargify has
+accepted it, and usage whose POST failed goes back to the store to be sent
+with the next flush. A POST that reached Chargify but whose response was
+lost is sent again. Usage held in a MemoryUsageStore is lost if the
+process dies without running its exit handlers; use a persistent store
+for stronger guarantees.
+'''
+
+import atexit
+import logging
+import threading
+
+log = logging.getLogger("pychargify")
+
+DEFAULT_MAX_EVENTS = 1000
+DEFAULT_FLUSH_INTERVAL = 60
+
+
+class BaseUsageStore(object):
+    """
+    Where recorded usage waits to be sent. claim() hands pending usage out
+    aggregated as (key, quantity, token) tuples, key being a
+    (subscription_id, component_id) tuple; every token is then either
+    acknowledged, once sent, or released back to the pending usage.
+    @license    GNU General Public License
+    """
+
+    def add(self, subscription_id, component_id, quantity):
+        raise NotImplementedError()
+
+    def claim(self):
+        raise NotImplementedError()
+
+    def ack(self, token):
+        raise NotImplementedError()
+
+    def release(self, token):
+        raise NotImplementedError()
+
+
+class MemoryUsageStore(BaseUsageStore):
+    """
+    Thread-safe in-process usage store
+    @license    GNU General Public License
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, subscription_id, component_id, quantity):
+        key = (subscription_id, component_id)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + quantity
+
+    def claim(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return [(key, quantity, (key, quantity))
+            for key, quantity in pending.items()]
+
+    def ack(self, token):
+        pass
+
+    def release(self, token):
+        key, quantity = token
+        self.add(key[0], key[1], quantity)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class UsageAccumulator(object):
+    """
+    Collects metered usage and sends it to Chargify in aggregate, so
+    recording usage costs no API call and sending it costs one call per
+    component per flush.
+
+    A background thread, started with the first record() call, flushes
+    every `interval` seconds, or as soon as `max_events` usages have been
+    recorded since the last flush. Pending usage is flushed once more when
+    the process exits.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, chargify, store=None, max_events=DEFAULT_MAX_EVENTS,
+            interval=DEFAULT_FLUSH_INTERVAL, memo=None):
+        """
+        chargify is the Chargify instance the usage is sent through; memo
+        is the memo of every usage sent
+        """
+        self.chargify = chargify
+        self.store = store if store is not None else MemoryUsageStore()
+        self.max_events = max_events
+        self.interval = interval
+        self.memo = memo
+        self.recorded = 0
+        self.sent = 0
+        self.failed = 0
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def record(self, subscription_id, component_id, quantity=1):
+        """
+        Record usage of a metered component
+        """
+        self.store.add(subscription_id, component_id, quantity)
+        with self._lock:
+            self.recorded += 1
+            self._events += 1
+            full = self._events >= self.max_events
+        if self._thread is None:
+            self.start()
+        if full:
+            self._wake.set()
+
+    def _send(self, key, quantity):
+        component = self.chargify.SubscriptionComponent()
+        component.subscription_id, component.component_id = key
+        component.kind = 'metered_component'
+        component.createUsage(quantity, self.memo)
+
+    def flush(self):
+        """
+        Send the pending usage, returns the number of usages that could not
+        be sent and were put back to be sent with the next flush
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._events = 0
+            failed = 0
+            for key, quantity, token in self.store.claim():
+                if not quantity:
+                    self.store.ack(token)
+                    continue
+                try:
+                    self._send(key, quantity)
+                except Exception:
+                    log.exception('sending usage of component %s of '
+                        'subscription %s failed' % (key[1], key[0]))
+                    self.store.release(token)
+                    failed += 1
+                else:
+                    self.store.ack(token)
+                    self.sent += 1
+            self.failed += failed
+            return failed
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stopping:
+                break
+            try:
+                self.flush()
+            except Exception:
+                log.exception('usage flush failed')
+
+    def start(self):
+        """
+        Start the background flushing thread, if it is not running yet
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run,
+                name='chargify-usage')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stop the background thread and flush the pending usage
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+        if thread is not None:
+            atexit.unregister(self.stop)
+            self._wake.set()
+            thread.join()
+        return self.flush()
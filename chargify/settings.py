@@ -21,7 +21,22 @@ if CHARGIFY_SHARED_KEY is None:
 
 del missing
 
-CHARGIFY = Chargify(CHARGIFY_API_KEY, CHARGIFY_SUBDOMAIN)
+# Name of a cache in CACHES used to cache catalog (product, product family
+# and component) responses, or None to disable response caching
+CHARGIFY_CACHE = getattr(settings, 'CHARGIFY_CACHE', None)
+
+# Seconds a request may wait on a silent connection to Chargify, or None
+# for the default of pychargify
+CHARGIFY_TIMEOUT = getattr(settings, 'CHARGIFY_TIMEOUT', None)
+
+CHARGIFY_OPTIONS = {}
+if CHARGIFY_TIMEOUT is not None:
+    CHARGIFY_OPTIONS['pool_timeout'] = CHARGIFY_TIMEOUT
+if CHARGIFY_CACHE is not None:
+    from chargify.pychargify.cache import DjangoCache
+    CHARGIFY_OPTIONS['cache'] = DjangoCache(CHARGIFY_CACHE)
+
+CHARGIFY = Chargify(CHARGIFY_API_KEY, CHARGIFY_SUBDOMAIN, **CHARGIFY_OPTIONS)
 
 DEFAULT_CHARGIFY_CC_TYPES = (
          ('Visa', 'Visa'),
@@ -1,11 +1,44 @@
 from chargify import models
 from chargify.settings import CHARGIFY
-from chargify.pychargify.api import ChargifyUnProcessableEntity
+from chargify.pychargify import api
+from chargify.pychargify.api import (Chargify, ChargifyCreditCard,
+    ChargifyNotFound, ChargifyServerError, ChargifySubscription,
+    ChargifyUnProcessableEntity)
+from chargify.pychargify.cache import LocalCache
+from chargify.pychargify.connection import DEFAULT_TIMEOUT, ConnectionPool, get_pool
+from chargify.pychargify.instrumentation import (RequestEvent,
+    RequestStats, url_template)
+from chargify.pychargify.scheduler import RequestScheduler, TokenBucket
+from chargify.pychargify.singleflight import SingleFlight
+from chargify.pychargify.transport import (CassetteError, RecordingTransport,
+    ReplayTransport)
+from chargify.pychargify.usage import UsageAccumulator
+from chargify.pychargify import iso8601
 from django.contrib.auth.models import User
-from django.test import TestCase
+from decimal import Decimal
+from django.utils import timezone
+import datetime
+from django.test import SimpleTestCase, TestCase
+from email.utils import formatdate
+from xml.dom import minidom
+from unittest import mock
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+import gzip
+import inspect
+import json
+import os
+import pickle
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 import time
+import zlib
 
-""" You must have a valid chargify account and have chargify setup in your settings to run tests """
+""" You must have a valid chargify account and have chargify setup in your settings to run the Api and
+Models tests; the others run against local stubs """
 
 def unique_reference():
     return str(int(time.time()*1000))
@@ -89,3 +122,1355 @@ class Models(TestCase):
         self.assertEqual(c.api.first_name, 'Hello')
         self.assertEqual(c.first_name, 'Hello')
         self.assertEqual(c.last_name, 'World')
+
+
+class StubServer(object):
+    """ A local HTTP server answering every request with
+    respond(connection, method, path), which returns the bytes to send and
+    what to do with the connection after: None to keep it open, 'close' or
+    'reset'. Returning None for the bytes sends nothing. The requests are
+    kept as (connection, method, path) tuples, connections being numbered
+    from 1 as they are accepted, and their bodies in bodies. """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self.bodies = []
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self._socket = socket.socket()
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(16)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self._socket.getsockname()[1]
+
+    def stop(self):
+        self._socket.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, address = self._socket.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+                number = self.connections
+            thread = threading.Thread(target=self._serve, args=(conn, number))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn, number):
+        rfile = conn.makefile('rb')
+        while True:
+            line = rfile.readline()
+            if not line:
+                conn.close()
+                return
+            method, path = line.decode('ascii').split()[:2]
+            length = 0
+            for header in iter(rfile.readline, b'\r\n'):
+                name, value = header.decode('ascii').split(':', 1)
+                if name.lower() == 'content-length':
+                    length = int(value)
+            body = rfile.read(length)
+            with self._lock:
+                self.requests.append((number, method, path))
+                self.bodies.append(body)
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            data, then = self.respond(number, method, path)
+            with self._lock:
+                self.active -= 1
+            if data:
+                conn.sendall(data)
+            if then == 'reset':
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0))
+            if then:
+                conn.close()
+                return
+
+
+CUSTOMER_XML = (b'<?xml version="1.0" encoding="UTF-8"?><customer>'
+    b'<id type="integer">1</id><reference>jane</reference></customer>')
+
+
+def ok(body=b'ok'):
+    return (b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body) +
+        body, None)
+
+
+def xml_array(root, items):
+    """ A listing body of the XML elements items """
+    return ('<?xml version="1.0" encoding="UTF-8"?><%s type="array">%s</%s>' % (
+        root, ''.join(items), root)).encode('utf-8')
+
+
+class StubApiTest(SimpleTestCase):
+    """ Tests against a Chargify served by a StubServer """
+
+    def serve(self, respond, **options):
+        """ Serve respond(method, path, query), returning the status and
+        body of a request, and return the server and a Chargify talking to
+        it. query is a dict of the query string values. """
+        def reply(n, method, path):
+            url = urlsplit(path)
+            status, body = respond(method, url.path,
+                dict(parse_qsl(url.query)))
+            return (b'HTTP/1.1 %d Stub\r\nContent-Length: %d\r\n\r\n' % (
+                status, len(body)) + body, None)
+        server = StubServer(reply)
+        self.addCleanup(server.stop)
+        return server, Chargify('api-key', server.host, base_host='',
+            secure=False, **options)
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    def serve(self, respond, **options):
+        server = StubServer(respond)
+        self.addCleanup(server.stop)
+        pool = ConnectionPool(server.host, secure=False, **options)
+        self.addCleanup(pool.clear)
+        return server, pool
+
+    def test_reuses_connections(self):
+        server, pool = self.serve(lambda n, method, path: ok())
+        for i in range(3):
+            response, data = pool.request('GET', '/customers.xml')
+            self.assertEqual(data, b'ok')
+        self.assertEqual(server.connections, 1)
+
+    def test_decompresses(self):
+        body = CUSTOMER_XML * 100
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for encoding, compressed in (('gzip', gzip.compress(body)),
+                ('deflate', zlib.compress(body)),
+                ('deflate', raw.compress(body) + raw.flush())):
+            server, pool = self.serve(lambda n, method, path: (
+                b'HTTP/1.1 200 OK\r\nContent-Encoding: %s\r\n'
+                b'Content-Length: %d\r\n\r\n' % (encoding.encode('ascii'),
+                len(compressed)) + compressed, None))
+            response, data = pool.request('GET', '/customers.xml')
+            self.assertEqual(data, body)
+
+    def test_timeout(self):
+        def respond(n, method, path):
+            if path == '/stalled.xml':
+                time.sleep(1)
+                return None, 'close'
+            return ok()
+        server, pool = self.serve(respond, size=1, timeout=0.2)
+        started = time.monotonic()
+        self.assertRaises(TimeoutError, pool.request, 'GET', '/stalled.xml')
+        self.assertTrue(time.monotonic() - started < 0.9)
+        # the stalled connection gave its place back
+        response, data = pool.request('GET', '/customers.xml')
+        self.assertEqual(data, b'ok')
+
+    def test_shared_pool_timeout(self):
+        host = 'timeout.example.com'
+        self.assertEqual(get_pool(host, secure=False).timeout, DEFAULT_TIMEOUT)
+        Chargify('api-key', host, base_host='', secure=False, pool_timeout=5)
+        self.assertEqual(get_pool(host, secure=False).timeout, 5)
+
+    def test_size_limit(self):
+        def respond(n, method, path):
+            time.sleep(0.05)
+            return ok()
+        server, pool = self.serve(respond, size=2)
+        threads = [threading.Thread(target=pool.request,
+            args=('GET', '/customers.xml')) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(server.requests), 6)
+        self.assertEqual(server.connections, 2)
+        self.assertEqual(server.max_active, 2)
+
+    def test_idle_eviction(self):
+        server, pool = self.serve(lambda n, method, path: ok(),
+            idle_timeout=0.05)
+        pool.request('GET', '/customers.xml')
+        time.sleep(0.1)
+        pool.request('GET', '/customers.xml')
+        self.assertEqual(server.connections, 2)
+
+    def test_reconnects_after_server_closed(self):
+        # closed by the server once idle, found before sending
+        server, pool = self.serve(lambda n, method, path: (ok()[0], 'close'))
+        pool.request('POST', '/customers.xml')
+        time.sleep(0.05)
+        pool.request('POST', '/customers.xml')
+        self.assertEqual(server.connections, 2)
+
+    def test_resends_idempotent_without_status_line(self):
+        # closed by the server as the second request arrives
+        def respond(n, method, path):
+            if len(server.requests) == 2:
+                return None, 'close'
+            return ok()
+        server, pool = self.serve(respond)
+        pool.request('GET', '/customers.xml')
+        response, data = pool.request('GET', '/customers.xml')
+        self.assertEqual(data, b'ok')
+        self.assertEqual([(n, method) for n, method, path in server.requests],
+            [(1, 'GET'), (1, 'GET'), (2, 'GET')])
+
+    def test_no_resend_of_post_without_status_line(self):
+        def respond(n, method, path):
+            if method == 'POST':
+                return None, 'close'
+            return ok()
+        server, pool = self.serve(respond)
+        pool.request('GET', '/customers.xml')
+        self.assertRaises(Exception, pool.request, 'POST', '/customers.xml')
+        self.assertEqual([method for n, method, path in server.requests],
+            ['GET', 'POST'])
+
+    def test_no_resend_once_response_started(self):
+        def respond(n, method, path):
+            if method == 'POST':
+                return (b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n'
+                    b'partial'), 'reset'
+            return ok()
+        server, pool = self.serve(respond)
+        pool.request('GET', '/customers.xml')
+        self.assertRaises(Exception, pool.request, 'POST', '/customers.xml')
+        time.sleep(0.05)
+        self.assertEqual([method for n, method, path in server.requests],
+            ['GET', 'POST'])
+
+
+class DecodeTest(SimpleTestCase):
+    def decode(self, fields, records=False):
+        api = ChargifySubscription('api-key', 'subdomain')
+        return api._applyA('<subscriptions type="array"><subscription>%s'
+            '</subscription></subscriptions>' % fields, 'ChargifySubscription',
+            'subscription', records=records)[0]
+
+    def test_each_element_decoded_by_its_type(self):
+        for records in (False, True):
+            subscription = self.decode('<balance_in_cents nil="true"/>'
+                '<activated_at nil="true"/>', records)
+            self.assertEqual(subscription.balance_in_cents, '')
+            self.assertEqual(subscription.activated_at, '')
+            subscription = self.decode(
+                '<balance_in_cents type="integer">500</balance_in_cents>'
+                '<activated_at type="datetime">2011-03-01T10:00:00-05:00'
+                '</activated_at>', records)
+            self.assertEqual(subscription.balance_in_cents, 500)
+            self.assertEqual(subscription.activated_at.hour, 15)
+
+    def test_json_decodes_to_the_same_shape(self):
+        card = ('<credit_card><id type="integer">7</id>'
+            '<masked_card_number>XXXX-1111</masked_card_number>'
+            '<expiration_month type="integer">10</expiration_month>'
+            '</credit_card>')
+        xml = ('<id type="integer">1</id><state>active</state>'
+            '<cancel_at_end_of_period type="boolean">false</cancel_at_end_of_period>'
+            '<updated_at type="datetime">2011-03-01T10:00:00-05:00</updated_at>'
+            '<customer><id type="integer">2</id><first_name>Jane</first_name>'
+            '</customer>'
+            '<product><id type="integer">3</id><handle>basic</handle></product>')
+        values = {'id': 1, 'state': 'active', 'cancel_at_end_of_period': False,
+            'updated_at': '2011-03-01T10:00:00-05:00',
+            'customer': {'id': 2, 'first_name': 'Jane'},
+            'product': {'id': 3, 'handle': 'basic'}}
+        api = ChargifySubscription('api-key', 'subdomain', format='json')
+        for card_xml, card_json in ((card, {'id': 7,
+                'masked_card_number': 'XXXX-1111', 'expiration_month': 10}),
+                ('', None)):
+            from_xml = self.decode(xml + card_xml)
+            from_json = api._applyA(json.dumps([{'subscription': dict(values,
+                credit_card=card_json)}]), 'ChargifySubscription',
+                'subscription')[0]
+            self.assertEqual(self.shape(from_json), self.shape(from_xml))
+            # a cardless subscription is written without its card
+            self.assertFalse('credit_card' in from_json._todict())
+            self.assertEqual(from_json._toxml().count(b'<credit_card'),
+                1 if card_json else 0)
+
+    def shape(self, obj):
+        """ The fields of a decoded object, nested ones included, with
+        their values """
+        if obj is None:
+            return None
+        names = set(obj.__dict__) | set(obj.__attribute_types__)
+        return dict((name, self.shape(getattr(obj, name)) if name in
+            obj.__attribute_types__ else getattr(obj, name))
+            for name in names if name not in obj.__ignore__)
+
+    def decode_chunks(self, body, size):
+        """ The text _decode_chunks() passes on to the parser for body read
+        size bytes at a time, and whether it switched to CP1252 """
+        text, utf8, cp1252 = [], b'', False
+        for part in api._decode_chunks(body[i:i + size]
+                for i in range(0, len(body), size)):
+            if isinstance(part, str):
+                text.append(utf8.decode('utf-8') + part)
+                utf8, cp1252 = b'', True
+            else:
+                utf8 += part
+        return ''.join(text) + utf8.decode('utf-8'), cp1252
+
+    def test_utf8_split_across_chunks(self):
+        text = 'Zo\u00eb \u20ac5 \U0001f600 Bj\u00f6rk'
+        body = text.encode('utf-8')
+        for size in range(1, len(body) + 1):
+            self.assertEqual(self.decode_chunks(body, size), (text, False))
+        with mock.patch.object(api, 'PARSE_CHUNK_SIZE', 7):
+            for padding in range(8):
+                name = '-' * padding + text
+                subscription = self.decode('<customer><first_name>%s'
+                    '</first_name></customer>' % name)
+                self.assertEqual(subscription.customer.first_name, name)
+                # as a response body, read through the chunked decoder
+                subscription = ChargifySubscription('api-key',
+                    'subdomain')._applyA(('<?xml version="1.0" encoding='
+                    '"UTF-8"?><subscription><customer><first_name>%s'
+                    '</first_name></customer></subscription>' % name).encode(
+                    'utf-8'), 'ChargifySubscription', 'subscription')[0]
+                self.assertEqual(subscription.customer.first_name, name)
+
+    def test_cp1252(self):
+        text = 'Caf\u00e9 \u20ac5 \u2013 na\u00efve'
+        body = text.encode('cp1252')
+        for size in range(1, len(body) + 1):
+            self.assertEqual(self.decode_chunks(body, size), (text, True))
+        # a body ending in the start of a UTF-8 sequence
+        self.assertEqual(self.decode_chunks(b'abc\xc3', 2), ('abc\u00c3',
+            True))
+
+    def test_utf8_then_cp1252(self):
+        head = 'Zo\u00eb ' * 3
+        tail = 'caf\u00e9 \u20ac'
+        body = head.encode('utf-8') + tail.encode('cp1252')
+        for size in range(1, len(body) + 1):
+            self.assertEqual(self.decode_chunks(body, size),
+                (head + tail, True))
+        with mock.patch.object(api, 'PARSE_CHUNK_SIZE', 5):
+            xml = (b'<?xml version="1.0" encoding="UTF-8"?><subscriptions '
+                b'type="array"><subscription><customer><first_name>' + body +
+                b'</first_name></customer></subscription></subscriptions>')
+            subscription = ChargifySubscription('api-key', 'subdomain')._applyA(
+                xml, 'ChargifySubscription', 'subscription')[0]
+        self.assertEqual(subscription.customer.first_name, head + tail)
+
+
+class StubResponse(object):
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class SchedulerTest(SimpleTestCase):
+    def send(self, scheduler, method, results):
+        """ Send through the scheduler a request getting the results in
+        turn, an exception to raise or a response status. Returns the
+        final status, the number of calls and the delays slept. """
+        calls = []
+
+        def request():
+            result = results[min(len(calls), len(results) - 1)]
+            calls.append(result)
+            if isinstance(result, Exception):
+                raise result
+            if isinstance(result, tuple):
+                return StubResponse(*result), b''
+            return StubResponse(result), b''
+        with mock.patch('time.sleep') as sleep:
+            response, data = scheduler.send(method, request)
+        return response.status, len(calls), [
+            call[0][0] for call in sleep.call_args_list]
+
+    def test_token_bucket_rate(self):
+        bucket = TokenBucket(50, burst=1)
+        started = time.monotonic()
+        for i in range(11):
+            bucket.acquire()
+        self.assertTrue(0.18 < time.monotonic() - started < 0.5)
+
+    def test_retries_idempotent_methods(self):
+        scheduler = RequestScheduler(backoff=0)
+        self.assertEqual(self.send(scheduler, 'GET', [503, 200])[:2], (200, 2))
+        self.assertEqual(self.send(scheduler, 'PUT',
+            [ConnectionResetError(), 200])[:2], (200, 2))
+        # rate limited requests were not processed, whatever the method
+        self.assertEqual(self.send(scheduler, 'POST', [429, 201])[:2],
+            (201, 2))
+
+    def test_does_not_retry_other_methods(self):
+        scheduler = RequestScheduler(backoff=0)
+        self.assertEqual(self.send(scheduler, 'POST', [503, 201])[:2],
+            (503, 1))
+        self.assertRaises(ConnectionResetError, self.send, scheduler, 'POST',
+            [ConnectionResetError(), 201])
+
+    def test_retry_after_seconds(self):
+        scheduler = RequestScheduler()
+        status, calls, delays = self.send(scheduler, 'GET',
+            [(429, {'Retry-After': '2'}), 200])
+        self.assertEqual((status, calls, delays[0]), (200, 2, 2))
+        # holds back the other requests too
+        self.assertTrue(scheduler._resume_at > time.monotonic() + 1)
+
+    def test_retry_after_date(self):
+        scheduler = RequestScheduler()
+        status, calls, delays = self.send(scheduler, 'POST',
+            [(429, {'Retry-After': formatdate(time.time() + 20,
+                usegmt=True)}), 201])
+        self.assertEqual((status, calls), (201, 2))
+        self.assertTrue(18 < delays[0] <= 20)
+
+    def test_retry_after_longer_than_max_backoff(self):
+        for retry_after in ('3600', formatdate(time.time() + 3600,
+                usegmt=True)):
+            scheduler = RequestScheduler(max_backoff=30)
+            self.assertEqual(self.send(scheduler, 'GET',
+                [(429, {'Retry-After': retry_after}), 200]), (429, 1, []))
+            self.assertEqual(scheduler._resume_at, 0)
+
+    def test_gives_up_after_retries(self):
+        scheduler = RequestScheduler(retries=2, backoff=0)
+        self.assertEqual(self.send(scheduler, 'GET', [503])[:2], (503, 3))
+        self.assertEqual(self.send(scheduler, 'GET', [429])[:2], (429, 3))
+        self.assertRaises(ConnectionResetError, self.send, scheduler, 'GET',
+            [ConnectionResetError()])
+
+
+class SingleFlightTest(SimpleTestCase):
+    def lookup(self, status=200, callers=5):
+        """ Look the same customer up from several threads at once through
+        a Chargify with coalescing on. Returns the server, the Chargify and
+        what every caller got back or raised. """
+        def respond(n, method, path):
+            time.sleep(0.2)
+            if status != 200:
+                return b'HTTP/1.1 %d Error\r\nContent-Length: 0\r\n\r\n' % (
+                    status), None
+            return ok(CUSTOMER_XML)
+        server = StubServer(respond)
+        self.addCleanup(server.stop)
+        chargify = Chargify('api-key', server.host, base_host='',
+            secure=False, singleflight=SingleFlight())
+        results = [None] * callers
+
+        def lookup(i):
+            try:
+                results[i] = chargify.Customer().getByReference('jane')
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=lookup, args=(i, ))
+            for i in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return server, chargify, results
+
+    def test_off_by_default(self):
+        self.assertFalse(Chargify('api-key', 'subdomain').options.get(
+            'singleflight'))
+
+    def test_one_request(self):
+        server, chargify, results = self.lookup()
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual([customer.reference for customer in results],
+            ['jane'] * 5)
+        # every caller gets its own object
+        self.assertEqual(len(set([id(customer) for customer in results])), 5)
+        results[0].reference = 'john'
+        self.assertEqual(results[1].reference, 'jane')
+        self.assertEqual(chargify.options['singleflight'].stats(),
+            {'calls': 5, 'saved': 4, 'in_flight': 0})
+
+    def test_error_reaches_every_caller(self):
+        server, chargify, results = self.lookup(status=404)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual([type(result) for result in results],
+            [ChargifyNotFound] * 5)
+        self.assertEqual(chargify.options['singleflight'].stats(),
+            {'calls': 5, 'saved': 4, 'in_flight': 0})
+
+
+class UsageAccumulatorTest(SimpleTestCase):
+    def accumulator(self, fail=(), **options):
+        """ Return an accumulator whose sends are kept in sent, failing for
+        the (subscription_id, component_id) keys in fail on the first try """
+        accumulator = UsageAccumulator(None, **options)
+        self.addCleanup(accumulator.stop)
+        sent = []
+        failed = set()
+
+        def send(key, quantity):
+            if key in fail and key not in failed:
+                failed.add(key)
+                raise ConnectionResetError()
+            sent.append((key, quantity))
+        accumulator._send = send
+        return accumulator, sent
+
+    def test_failed_send_is_sent_with_next_flush(self):
+        accumulator, sent = self.accumulator(fail=[(1, 500)])
+        accumulator.store.add(1, 500, 2)
+        accumulator.store.add(1, 500, 3)
+        accumulator.store.add(2, 500, 1)
+        self.assertEqual(accumulator.flush(), 1)
+        self.assertEqual(sent, [((2, 500), 1)])
+        self.assertEqual(len(accumulator.store), 1)
+        accumulator.store.add(1, 500, 1)
+        self.assertEqual(accumulator.flush(), 0)
+        self.assertEqual(sent, [((2, 500), 1), ((1, 500), 6)])
+        self.assertEqual((accumulator.sent, accumulator.failed), (2, 1))
+
+    def test_max_events_wakes_thread(self):
+        accumulator, sent = self.accumulator(max_events=3, interval=60)
+        for i in range(3):
+            accumulator.record(1, 500)
+        deadline = time.monotonic() + 2
+        while not sent and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sent, [((1, 500), 3)])
+
+    def test_stop_flushes(self):
+        accumulator, sent = self.accumulator(interval=60)
+        accumulator.record(1, 500, 2)
+        accumulator.record(1, 501)
+        self.assertEqual(accumulator.stop(), 0)
+        self.assertEqual(sorted(sent), [((1, 500), 2), ((1, 501), 1)])
+        self.assertEqual(len(accumulator.store), 0)
+
+
+class PendingUsageStoreTest(TestCase):
+    def test_claim_ack_release(self):
+        store = models.PendingUsageStore()
+        store.add(1, 500, 2)
+        store.add(1, 500, 3)
+        store.add(2, 500, 1)
+        claimed = sorted(store.claim())
+        self.assertEqual([(key, quantity) for key, quantity, token in claimed],
+            [((1, 500), Decimal('5')), ((2, 500), Decimal('1'))])
+        # claimed usage is not handed out twice
+        self.assertEqual(store.claim(), [])
+        store.ack(claimed[0][2])
+        store.release(claimed[1][2])
+        self.assertEqual([(key, quantity) for key, quantity, token in
+            store.claim()], [((2, 500), Decimal('1'))])
+        self.assertEqual(models.PendingUsage.objects.count(), 1)
+
+    def test_claims_again_after_timeout(self):
+        store = models.PendingUsageStore(claim_timeout=0)
+        store.add(1, 500, 2)
+        self.assertEqual(len(store.claim()), 1)
+        time.sleep(0.01)
+        self.assertEqual([(key, quantity) for key, quantity, token in
+            store.claim()], [((1, 500), Decimal('2'))])
+
+
+class UpdateAllocationsTest(StubApiTest):
+    def respond(self, method, path, query):
+        subscription_id, component_id = path.split('/')[2:5:2]
+        component_id = component_id.split('.')[0]
+        if component_id == '404':
+            return 404, b''
+        return 200, ('<?xml version="1.0" encoding="UTF-8"?><component>'
+            '<component_id type="integer">%s</component_id>'
+            '<subscription_id type="integer">%s</subscription_id>'
+            '<allocated_quantity type="integer">%s</allocated_quantity>'
+            '</component>' % (component_id, subscription_id,
+            subscription_id)).encode('utf-8')
+
+    def test_reports_every_allocation_in_order(self):
+        server, chargify = self.serve(self.respond)
+        allocations = [(n, 500, n) for n in range(1, 9)] + [(9, 500, 'x'),
+            (10, 404, 1), (11, 500, True)]
+        results = chargify.SubscriptionComponent().updateAllocations(
+            allocations, workers=2)
+        self.assertEqual([(r.subscription_id, r.component_id, r.value)
+            for r in results], allocations)
+        self.assertEqual([r.ok for r in results], [True] * 8 + [False, False,
+            True])
+        self.assertTrue(isinstance(results[8].error, ValueError))
+        self.assertTrue(isinstance(results[9].error, ChargifyNotFound))
+        # the bad value is never sent
+        self.assertEqual(len(server.requests), 10)
+        self.assertEqual([r.component for r in results], [None] * 11)
+
+    def test_decode(self):
+        server, chargify = self.serve(self.respond)
+        results = chargify.SubscriptionComponent().updateAllocations(
+            [(1, 500, 5), (2, 404, 1)], decode=True)
+        self.assertEqual(results[0].component.allocated_quantity, 1)
+        self.assertEqual(results[0].component.component_id, 500)
+        self.assertEqual((results[1].ok, results[1].component), (False, None))
+
+
+class SyncChangedTest(StubApiTest, TestCase):
+    def setUp(self):
+        # customer id: updated_at
+        self.updated = {
+            1: datetime.datetime(2011, 3, 1, 10, tzinfo=iso8601.UTC),
+            2: datetime.datetime(2011, 3, 2, 10, tzinfo=iso8601.UTC),
+            3: datetime.datetime(2011, 3, 3, 10, tzinfo=iso8601.UTC),
+        }
+        self.queries = []
+        self.server, chargify = self.serve(self.respond)
+        patcher = mock.patch.object(models.Customer, 'gateway', chargify)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def respond(self, method, path, query):
+        self.queries.append(query)
+        since = query.get('start_datetime')
+        if since:
+            since = datetime.datetime.fromisoformat(since)
+        ids = [id for id in sorted(self.updated)
+            if since is None or self.updated[id] >= since]
+        if query.get('page', '1') != '1':
+            ids = []
+        return 200, xml_array('customers', ['<customer>'
+            '<id type="integer">%d</id><first_name>Jane</first_name>'
+            '<last_name>Doe</last_name><email>jane%d@example.com</email>'
+            '<reference>jane%d</reference>'
+            '<updated_at type="datetime">%s</updated_at></customer>' % (
+            id, id, id, self.updated[id].isoformat()) for id in ids])
+
+    def mark(self):
+        return models.SyncMark.objects.get(resource='customers').updated_at
+
+    def test_syncs_only_the_changes(self):
+        self.assertEqual(models.Customer.objects.sync_changed(), 3)
+        self.assertEqual(models.Customer.objects.count(), 3)
+        self.assertEqual(self.mark(),
+            models.from_api_datetime(self.updated[3]))
+        self.assertFalse('start_datetime' in self.queries[0])
+
+        self.updated[1] = datetime.datetime(2011, 3, 4, 10, tzinfo=iso8601.UTC)
+        self.queries = []
+        self.assertEqual(models.Customer.objects.sync_changed(), 2)
+        self.assertEqual(self.queries[0]['date_field'], 'updated_at')
+        self.assertEqual(datetime.datetime.fromisoformat(
+            self.queries[0]['start_datetime']), self.updated[3])
+        self.assertEqual(self.mark(),
+            models.from_api_datetime(self.updated[1]))
+        self.assertEqual(models.Customer.objects.count(), 3)
+        self.assertEqual(models.Customer.objects.get(chargify_id=1
+            ).chargify_updated_at, models.from_api_datetime(self.updated[1]))
+
+    def test_mark_stays_behind_the_sync_start(self):
+        # updated while the sync ran, after the pages listed before it
+        self.updated[3] = timezone.now() + datetime.timedelta(hours=1)
+        if timezone.is_naive(self.updated[3]):
+            self.updated[3] = timezone.make_aware(self.updated[3])
+        models.Customer.objects.sync_changed()
+        self.assertTrue(self.mark() < models.from_api_datetime(
+            datetime.datetime.now(iso8601.UTC)) - models.SYNC_CLOCK_SKEW +
+            datetime.timedelta(seconds=1))
+
+
+SUBSCRIPTION_XML = ('<subscription><id type="integer">1</id>'
+    '<state>active</state>'
+    '<balance_in_cents type="integer">500</balance_in_cents>'
+    '<customer><id type="integer">2</id><first_name>Jane</first_name>'
+    '</customer><product><id type="integer">3</id><handle>basic</handle>'
+    '</product><components type="array"><component>'
+    '<component_id type="integer">500</component_id></component>'
+    '<component><component_id type="integer">501</component_id>'
+    '</component></components></subscription>')
+
+
+class RecordTest(SimpleTestCase):
+    def decode(self, records):
+        api = ChargifySubscription('api-key', 'subdomain', format='xml')
+        return api, api._applyA(xml_array('subscriptions', [SUBSCRIPTION_XML]),
+            'ChargifySubscription', 'subscription', records=records)[0]
+
+    def test_record(self):
+        api, record = self.decode(True)
+        self.assertEqual((record.id, record.state, record.balance_in_cents),
+            (1, 'active', 500))
+        self.assertEqual(record.customer.first_name, 'Jane')
+        # class defaults for the fields the response left out
+        self.assertEqual(record.expires_at, None)
+        self.assertEqual(tuple([c.component_id for c in record.components]),
+            (500, 501))
+        self.assertRaises(AttributeError, setattr, record, 'state', 'past_due')
+        self.assertFalse(hasattr(record, 'api_key'))
+
+    def test_pickle(self):
+        api, record = self.decode(True)
+        copy = pickle.loads(pickle.dumps(record))
+        self.assertEqual(copy, record)
+        self.assertEqual(copy.customer.first_name, 'Jane')
+
+    def test_from_record(self):
+        api, record = self.decode(True)
+        api, obj = self.decode(False)
+        subscription = api.fromRecord(record)
+        self.assertEqual(type(subscription), ChargifySubscription)
+        self.assertEqual(subscription._toxml(), obj._toxml())
+        self.assertEqual([type(c).__name__ for c in subscription.components],
+            ['ChargifySubscriptionComponent'] * 2)
+        self.assertEqual(subscription.request_host, api.request_host)
+
+    def test_objects_share_the_options(self):
+        api, obj = self.decode(False)
+        self.assertTrue(obj.options is api.options)
+        self.assertTrue(obj.customer.options is api.options)
+        self.assertTrue(obj.components[0].options is api.options)
+        self.assertEqual(obj.customer.request_host, 'subdomain.chargify.com')
+
+
+class ListingTest(StubApiTest):
+    """ Against a stub serving `customers` customers 20 (or per_page) to
+    a page, each page taking up to `latency` seconds, page `failing`
+    failing with a 500 """
+    customers = 45
+    latency = 0
+    failing = None
+
+    def respond(self, method, path, query):
+        if path == '/products.xml':
+            return 200, xml_array('products', ['<product><id type="integer">'
+                '%d</id></product>' % id for id in (1, 2)])
+        page = int(query.get('page', 1))
+        per_page = int(query.get('per_page', 20))
+        # later pages answer first
+        time.sleep(self.latency / page)
+        if page == self.failing:
+            return 500, b''
+        ids = range((page - 1) * per_page + 1,
+            min(page * per_page, self.customers) + 1)
+        return 200, xml_array('customers', ['<customer><id type="integer">'
+            '%d</id></customer>' % id for id in ids])
+
+    def setUp(self):
+        self.server, self.chargify = self.serve(self.respond,
+            scheduler=RequestScheduler(retries=0))
+
+    def pages(self):
+        """ The pages requested so far """
+        return sorted([int(dict(parse_qsl(urlsplit(path).query)).get('page',
+            1)) for n, method, path in self.server.requests])
+
+
+class IterPagesTest(ListingTest):
+    latency = 0.05
+
+    def test_pages_in_order(self):
+        for window in (1, 4):
+            self.chargify.options['prefetch_pages'] = window
+            pages = list(self.chargify.Customer().iterPages(per_page=10))
+            self.assertEqual([len(page) for page in pages], [10] * 4 + [5])
+            self.assertEqual([c.id for page in pages for c in page],
+                list(range(1, 46)))
+
+    def test_stops_at_first_empty_page(self):
+        self.chargify.options['prefetch_pages'] = 3
+        self.assertEqual(len(list(self.chargify.Customer().iterAll(
+            per_page=10))), 45)
+        # page 6 is empty; at most a window of pages is asked past it
+        self.assertEqual(self.pages()[:6], [1, 2, 3, 4, 5, 6])
+        self.assertTrue(max(self.pages()) <= 8)
+
+    def test_failed_page_cancels_pending_pages(self):
+        self.failing = 3
+        self.chargify.options['prefetch_pages'] = 2
+        self.assertRaises(ChargifyServerError, list,
+            self.chargify.Customer().iterAll(per_page=1))
+        time.sleep(0.1)
+        self.assertEqual(self.pages(), [1, 2, 3, 4])
+
+    def test_per_page_and_start_page(self):
+        customers = list(self.chargify.Customer().iterAll(per_page=10, page=3))
+        self.assertEqual([c.id for c in customers], list(range(21, 46)))
+        self.assertEqual(self.pages()[0], 3)
+        for n, method, path in self.server.requests:
+            self.assertTrue('per_page=10' in path)
+
+    def test_closing_early_stops_paging(self):
+        executors = lambda: len([thread for thread in threading.enumerate()
+            if thread.name.startswith('ThreadPoolExecutor')])
+        running = executors()
+        self.chargify.options['prefetch_pages'] = 4
+        pages = self.chargify.Customer().iterPages(per_page=1)
+        next(pages)
+        pages.close()
+        self.assertEqual(executors(), running)
+        requested = len(self.server.requests)
+        self.assertTrue(requested <= 5)
+        time.sleep(0.1)
+        self.assertEqual(len(self.server.requests), requested)
+
+
+class GetAllTest(ListingTest):
+    def test_collects_everything(self):
+        self.assertEqual([c.id for c in self.chargify.Customer().getAll()],
+            list(range(1, 46)))
+
+    def test_on_page_returns_last_page(self):
+        handed = []
+        last = self.chargify.Customer().getAll(per_page=10,
+            on_page=lambda page, customers: handed.append((page,
+                [c.id for c in customers])))
+        self.assertEqual(last, 5)
+        self.assertEqual([page for page, ids in handed], [1, 2, 3, 4, 5])
+        self.assertEqual(handed[4][1], list(range(41, 46)))
+
+    def test_resume(self):
+        handed = []
+        last = self.chargify.Customer().getAll(per_page=10, resume=2,
+            on_page=lambda page, customers: handed.append((page,
+                customers[0].id)))
+        self.assertEqual(last, 5)
+        self.assertEqual(handed, [(3, 21), (4, 31), (5, 41)])
+        self.assertEqual(min(self.pages()), 3)
+        # past the end, nothing more to hand over
+        self.assertEqual(self.chargify.Customer().getAll(per_page=10,
+            resume=5, on_page=lambda page, customers: None), 5)
+
+    def test_max_pages(self):
+        self.chargify.options['prefetch_pages'] = 4
+        handed = []
+        last = self.chargify.Customer().getAll(per_page=10, max_pages=2,
+            on_page=lambda page, customers: handed.append(page))
+        self.assertEqual((last, handed), (2, [1, 2]))
+        self.assertEqual(len(self.chargify.Customer().getAll(per_page=10,
+            max_pages=3)), 30)
+        # no page past the limit is asked for
+        self.assertEqual(self.pages(), [1, 1, 2, 2, 3])
+
+    def test_listing_without_paging(self):
+        handed = []
+        product = self.chargify.Product()
+        self.assertEqual(product.getAll(on_page=lambda page, products:
+            handed.append((page, len(products)))), 1)
+        self.assertEqual(handed, [(1, 2)])
+        self.assertEqual(product.getAll(on_page=handed.append, resume=1), 1)
+        self.assertEqual(product.getAll(resume=1), [])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_empty_listing(self):
+        self.customers = 0
+        handed = []
+        self.assertEqual(self.chargify.Customer().getAll(
+            on_page=lambda page, customers: handed.append(page)), None)
+        self.assertEqual(handed, [])
+        self.assertEqual(self.chargify.Customer().getAll(), [])
+
+
+def legacy_toxml(obj, dom=None):
+    """ The minidom serializer _toxml() replaced, which the current one
+    must match byte for byte; None when obj has nothing to send """
+    if dom is None:
+        dom = minidom.Document()
+        dom.appendChild(legacy_toxml(obj, dom))
+        return dom.toxml(encoding='utf-8')
+    if obj.__xmlnodename__ == 'component':
+        if obj.kind == 'metered_component':
+            return None
+        property = 'enabled' if obj.kind == 'on_off_component' else \
+            'allocated_quantity'
+        values = [('component_id', obj.component_id),
+            (property, getattr(obj, property))]
+        if not values[1][1]:
+            return None
+    else:
+        values = obj.__dict__.items()
+    element = dom.createElement(obj.__xmlnodename__)
+    for property, value in values:
+        if not property in obj.__ignore__ and not inspect.isfunction(value):
+            if property in obj.__attribute_types__:
+                if type(value) == list:
+                    node = dom.createElement(property)
+                    node.setAttribute('type', 'array')
+                    for v in value:
+                        child = legacy_toxml(v, dom)
+                        if child is not None:
+                            node.appendChild(child)
+                    element.appendChild(node)
+                else:
+                    element.appendChild(legacy_toxml(value, dom))
+            else:
+                if isinstance(value, bool):
+                    value = str(value).lower()
+                node = dom.createElement(property)
+                node.appendChild(dom.createTextNode(str(value)))
+                element.appendChild(node)
+    return element
+
+
+class SerializeTest(StubApiTest):
+    def subscription(self):
+        api = ChargifySubscription('api-key', 'subdomain')
+        return api._applyA(xml_array('subscriptions', [SUBSCRIPTION_XML]),
+            'ChargifySubscription', 'subscription')[0]
+
+    def test_same_output_as_minidom(self):
+        subscription = self.subscription()
+        subscription.customer.organization = 'Smith & Sons <"Ltd">'
+        subscription.cancel_at_end_of_period = True
+        subscription.product.require_credit_card = False
+        subscription.updated_at = datetime.datetime(2011, 3, 1, 15, 22, 33,
+            tzinfo=iso8601.UTC)
+        subscription.components[0].kind = 'on_off_component'
+        subscription.components[0].enabled = True
+        subscription.components[1].kind = 'quantity_based_component'
+        subscription.components[1].allocated_quantity = 5
+        xml = subscription._toxml()
+        self.assertEqual(xml, legacy_toxml(subscription))
+        self.assertTrue(b'<organization>Smith &amp; Sons &lt;&quot;Ltd&quot;'
+            b'&gt;</organization>' in xml)
+        self.assertTrue(b'<cancel_at_end_of_period>true</cancel_at_end_of_period>'
+            in xml)
+        self.assertTrue(b'<updated_at>2011-03-01 15:22:33+00:00</updated_at>'
+            in xml)
+        self.assertTrue(b'<components type="array"><component>'
+            b'<component_id>500</component_id><enabled>true</enabled>'
+            b'</component><component><component_id>501</component_id>'
+            b'<allocated_quantity>5</allocated_quantity></component>'
+            b'</components>' in xml)
+
+    def payloads(self, format):
+        """ The bodies of an upgrade, an unsubscribe and a credit card
+        update sent in format """
+        body = (SUBSCRIPTION_XML.encode() if format == 'xml' else
+            json.dumps({'subscription': {'id': 1}}).encode())
+        server, chargify = self.serve(lambda method, path, query: (200, body),
+            format=format)
+        subscription = chargify.Subscription()
+        subscription.id = 1
+        subscription.upgrade('pro & "max"')
+        subscription.unsubscribe('too <expensive>')
+        card = chargify.CreditCard()
+        card.full_number = '4111 & 1'
+        card.expiration_month = 10
+        card.save(subscription)
+        self.assertEqual([(method, path) for n, method, path in
+            server.requests], [('PUT', '/subscriptions/1.%s' % format),
+            ('DELETE', '/subscriptions/1.%s' % format),
+            ('PUT', '/subscriptions/1.%s' % format)])
+        return server.bodies
+
+    def test_xml_payloads(self):
+        declaration = b'<?xml version="1.0" encoding="UTF-8"?>'
+        self.assertEqual(self.payloads('xml'), [
+            declaration + b'<subscription><product_handle>pro &amp; '
+                b'&quot;max&quot;</product_handle></subscription>',
+            declaration + b'<subscription><cancellation_message>too '
+                b'&lt;expensive&gt;</cancellation_message></subscription>',
+            declaration + b'<subscription><credit_card_attributes>'
+                b'<full_number>4111 &amp; 1</full_number>'
+                b'<expiration_month>10</expiration_month>'
+                b'</credit_card_attributes></subscription>'])
+
+    def test_json_payloads(self):
+        self.assertEqual([json.loads(body) for body in self.payloads('json')], [
+            {'subscription': {'product_handle': 'pro & "max"'}},
+            {'subscription': {'cancellation_message': 'too <expensive>'}},
+            {'subscription': {'credit_card_attributes': {
+                'full_number': '4111 & 1', 'expiration_month': 10}}}])
+
+
+class TransportTest(StubApiTest):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cassette')
+
+    def record(self):
+        """ Record two reads of a customer and a save of it to the
+        cassette """
+        names = iter(['Jane', 'Joan'])
+        def respond(method, path, query):
+            if method == 'GET':
+                name = next(names)
+            else:
+                name = 'Saved'
+            return 200, ('<?xml version="1.0" encoding="UTF-8"?><customer>'
+                '<id type="integer">1</id><first_name>%s</first_name>'
+                '</customer>' % name).encode('utf-8')
+        transport = RecordingTransport(self.path, secure=False)
+        server, chargify = self.serve(respond, transport=transport)
+        names_read = [chargify.Customer().getById(1).first_name
+            for i in range(2)]
+        self.customer(chargify, 'jane').save()
+        transport.close()
+        self.assertEqual(names_read, ['Jane', 'Joan'])
+        self.assertEqual(len(server.requests), 3)
+        return server.host
+
+    def customer(self, chargify, reference):
+        customer = chargify.Customer()
+        customer.id = 1
+        customer.reference = reference
+        return customer
+
+    def replay(self, host, **options):
+        transport = ReplayTransport(self.path, **options)
+        self.addCleanup(transport.close)
+        return transport, Chargify('api-key', host, base_host='',
+            secure=False, transport=transport)
+
+    def test_replay(self):
+        transport, chargify = self.replay(self.record())
+        # repeats past the recording get the last response again
+        self.assertEqual([chargify.Customer().getById(1).first_name
+            for i in range(3)], ['Jane', 'Joan', 'Joan'])
+        self.assertEqual(self.customer(chargify, 'jane').save()[1].first_name,
+            'Saved')
+        transport.rewind()
+        self.assertEqual(chargify.Customer().getById(1).first_name, 'Jane')
+        self.assertEqual(transport.misses, 0)
+
+    def test_miss(self):
+        host = self.record()
+        transport, chargify = self.replay(host)
+        self.assertRaises(CassetteError, chargify.Customer().getById, 2)
+        self.assertRaises(CassetteError, chargify.Customer()._fetchS,
+            'POST', '/customers/1.xml', 'ChargifyCustomer', 'customer')
+        # a save sending another body
+        self.assertRaises(CassetteError, self.customer(chargify, 'joan').save)
+        self.assertEqual(transport.misses, 3)
+        transport, chargify = self.replay(host, match_body=False)
+        self.assertEqual(self.customer(chargify, 'joan').save()[1].first_name,
+            'Saved')
+
+    def test_truncated(self):
+        self.record()
+        with open(self.path, 'rb') as cassette:
+            recording = cassette.read()
+        for size in (len(recording) - 1, len(recording) - 100, 30):
+            with open(self.path, 'wb') as cassette:
+                cassette.write(recording[:size])
+            self.assertRaises(CassetteError, ReplayTransport, self.path)
+        with open(self.path, 'wb') as cassette:
+            cassette.write(b'not a cassette at all')
+        self.assertRaises(CassetteError, ReplayTransport, self.path)
+
+
+class LocalCacheTest(StubApiTest):
+    def test_ttl(self):
+        cache = LocalCache()
+        with mock.patch('chargify.pychargify.cache.time.monotonic',
+                return_value=100.0) as clock:
+            cache.set('products', 'a', b'body', 10)
+            clock.return_value = 109.9
+            self.assertEqual(cache.get('products', 'a'), b'body')
+            clock.return_value = 110.0
+            self.assertEqual(cache.get('products', 'a'), None)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1,
+            'entries': 0})
+
+    def test_lru_eviction(self):
+        cache = LocalCache(max_entries=2)
+        cache.set('products', 'a', b'a', 60)
+        cache.set('products', 'b', b'b', 60)
+        # reading a makes b the least recently used
+        cache.get('products', 'a')
+        cache.set('products', 'c', b'c', 60)
+        self.assertEqual([cache.get('products', key) for key in 'abc'],
+            [b'a', None, b'c'])
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1,
+            'entries': 2})
+
+    def test_invalidate(self):
+        cache = LocalCache()
+        cache.set('products', 'a', b'a', 60)
+        cache.set('components', 'a', b'b', 60)
+        cache.invalidate('products')
+        self.assertEqual(cache.get('products', 'a'), None)
+        self.assertEqual(cache.get('components', 'a'), b'b')
+        cache.invalidate()
+        self.assertEqual(cache.get('components', 'a'), None)
+
+    def test_save_invalidates(self):
+        def respond(method, path, query):
+            return 200, ('<?xml version="1.0" encoding="UTF-8"?><product>'
+                '<id type="integer">1</id><handle>basic</handle>'
+                '</product>').encode('utf-8')
+        cache = LocalCache()
+        server, chargify = self.serve(respond, cache=cache)
+        for i in range(2):
+            self.assertEqual(chargify.Product().getById(1).handle, 'basic')
+        # customers have no TTL and are not cached
+        for i in range(2):
+            chargify.Customer().getById(1)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        product = chargify.Product()
+        product.id = 1
+        product.handle = 'basic'
+        product.save()
+        chargify.Product().getById(1)
+        self.assertEqual([(method, path) for n, method, path in
+            server.requests[3:]], [('PUT', '/products/1.xml'),
+            ('GET', '/products/1.xml')])
+
+
+class NoFromIsoFormat(datetime.datetime):
+    """ A datetime without the parser of the parse_datetime() fast path """
+
+    @classmethod
+    def fromisoformat(cls, s):
+        raise ValueError(s)
+
+
+class Iso8601Test(SimpleTestCase):
+    CASES = (
+        ('2011-03-01T10:00:00-05:00', (2011, 3, 1, 15, 0, 0, 0)),
+        ('2011-03-01T10:00:00+05:30', (2011, 3, 1, 4, 30, 0, 0)),
+        ('2011-03-01T10:00:00Z', (2011, 3, 1, 10, 0, 0, 0)),
+        ('2011-03-01T22:00:00-05:00', (2011, 3, 2, 3, 0, 0, 0)),
+        ('2011-03-01T10:00:00.5+01:00', (2011, 3, 1, 9, 0, 0, 500000)),
+        ('2011-03-01T10:00:00.123456Z', (2011, 3, 1, 10, 0, 0, 123456)),
+        ('2011-03-01T10:00:00,25Z', (2011, 3, 1, 10, 0, 0, 250000)),
+        ('2011-03-01T10:00-0500', (2011, 3, 1, 15, 0, 0, 0)),
+    )
+
+    def setUp(self):
+        iso8601.parse_datetime.cache_clear()
+        self.addCleanup(iso8601.parse_datetime.cache_clear)
+
+    def assertUTC(self, value, expected):
+        self.assertEqual(value, datetime.datetime(*expected,
+            tzinfo=iso8601.UTC))
+        self.assertTrue(value.tzinfo is iso8601.UTC)
+
+    def test_fast_path(self):
+        for s, expected in self.CASES:
+            self.assertUTC(iso8601.parse_datetime(s), expected)
+        # remembered
+        s = self.CASES[0][0]
+        self.assertTrue(iso8601.parse_datetime(s) is
+            iso8601.parse_datetime(''.join(s)))
+
+    def test_regex_fallback(self):
+        with mock.patch.object(iso8601, 'datetime', SimpleNamespace(
+                datetime=NoFromIsoFormat, timedelta=datetime.timedelta)):
+            for s, expected in self.CASES:
+                self.assertUTC(iso8601.parse_datetime(s), expected)
+
+    def test_forms_only_the_regex_reads(self):
+        # naive date-only strings are taken as midnight UTC
+        self.assertUTC(iso8601.parse_datetime('2011-03-01'),
+            (2011, 3, 1, 0, 0, 0, 0))
+        # ordinal dates
+        self.assertUTC(iso8601.parse_datetime('2011-060T10:00Z'),
+            (2011, 3, 1, 10, 0, 0, 0))
+
+    def test_invalid(self):
+        for s in ('2011-03-01T10:00:00', '2011-13-01T10:00:00Z',
+                '2011-03-01T25:00:00Z', 'yesterday', ''):
+            self.assertRaises(ValueError, iso8601.parse_datetime, s)
+
+
+class PostBackTest(StubApiTest):
+    def test_postback(self):
+        def respond(method, path, query):
+            id = path.split('/')[-1].split('.')[0]
+            if id == '404':
+                return 404, b''
+            # the later ids answer first
+            time.sleep(0.01 * (4 - int(id)))
+            return 200, SUBSCRIPTION_XML.replace('<id type="integer">1</id>',
+                '<id type="integer">%s</id>' % id, 1).encode('utf-8')
+        server, chargify = self.serve(respond)
+        with self.assertLogs('pychargify', 'ERROR') as logs:
+            postback = chargify.PostBack(json.dumps([3, 1, 404, 2, 1]))
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual([s.id for s in postback.subscriptions], [3, 1, 2, 1])
+        self.assertTrue(postback.subscriptions[1] is postback.subscriptions[3])
+        self.assertEqual(list(postback.errors), [404])
+        self.assertTrue(isinstance(postback.errors[404], ChargifyNotFound))
+        # each subscription fetched once
+        self.assertEqual(sorted(path for n, method, path in server.requests),
+            ['/subscriptions/%s.xml' % id for id in (1, 2, 3, 404)])
+        # nothing is shared between postbacks
+        other = chargify.PostBack(json.dumps([2]), workers=1)
+        self.assertEqual([s.id for s in other.subscriptions], [2])
+        self.assertEqual(other.errors, {})
+        self.assertEqual(len(postback.subscriptions), 4)
+        self.assertEqual(chargify.PostBack('').subscriptions, [])
+
+
+class ComponentIndexTest(StubApiTest):
+    def serve_components(self, **options):
+        def respond(method, path, query):
+            family = path.split('/')[2]
+            return 200, xml_array('components', ['<component>'
+                '<id type="integer">%s</id><name>%s %s</name></component>' % (
+                id, family, id) for id in (10, 11)])
+        return self.serve(respond, **options)
+
+    def paths(self, server):
+        return [path for n, method, path in server.requests]
+
+    def test_family_fetched_once(self):
+        server, chargify = self.serve_components()
+        self.assertEqual(chargify.Component().getByIds(1, 10).name, '1 10')
+        self.assertEqual(chargify.Component().getByIds(1, '11').name, '1 11')
+        self.assertEqual(chargify.Component().getByIds(1, 12), None)
+        self.assertEqual(sorted(c.id for c in
+            chargify.Component().getByProductFamilyId(1)), [10, 11])
+        self.assertEqual(chargify.Component().getByIds(2, 10).name, '2 10')
+        self.assertEqual(self.paths(server), [
+            '/product_families/1/components.xml',
+            '/product_families/2/components.xml'])
+        # objects made from the index are independent of it
+        component = chargify.Component().getByIds(1, 10)
+        component.name = 'renamed'
+        self.assertEqual(chargify.Component().getByIds(1, 10).name, '1 10')
+
+    def test_invalidate(self):
+        server, chargify = self.serve_components()
+        chargify.Component().getByIds(1, 10)
+        chargify.Component().invalidateCache()
+        chargify.Component().getByIds(1, 10)
+        self.assertEqual(self.paths(server), [
+            '/product_families/1/components.xml'] * 2)
+
+    def test_no_ttl(self):
+        server, chargify = self.serve_components(cache_ttls={'components': 0})
+        chargify.Component().getByIds(1, 10)
+        chargify.Component().getByIds(1, 11)
+        self.assertEqual(len(server.requests), 2)
+
+
+class InstrumentationTest(StubApiTest):
+    def test_url_template(self):
+        for url, template in (
+                ('/subscriptions/123/components/4.xml?x=1',
+                    '/subscriptions/:id/components/:id.xml'),
+                ('/product_families/5/components.json',
+                    '/product_families/:id/components.json'),
+                ('/products/handle/basic-plan.xml',
+                    '/products/handle/:handle.xml'),
+                ('/products/handle/v1.2.json', '/products/handle/:handle.json'),
+                ('/products/handle/123.xml', '/products/handle/:handle.xml'),
+                ('/customers.xml?page=2&per_page=50', '/customers.xml'),
+                ('/customers/lookup.xml?reference=77',
+                    '/customers/lookup.xml')):
+            self.assertEqual(url_template(url), template)
+
+    def event(self, method, url, total_time, status=200, attempts=1,
+            error=None):
+        event = RequestEvent(method, url)
+        event.status = status
+        event.total_time = total_time
+        event.ttfb = total_time / 2
+        event.attempts = attempts
+        event.error = error
+        event.bytes_out = 100
+        event.bytes_in = 2048
+        return event
+
+    def test_aggregation(self):
+        stats = RequestStats()
+        for event in (self.event('GET', '/customers/1.xml', 0.004),
+                self.event('GET', '/customers/2.xml', 0.008, attempts=3),
+                self.event('GET', '/customers/3.xml', 0.03, status=404),
+                self.event('PUT', '/customers/1.xml', 0.5,
+                    error=ConnectionError()),
+                self.event('GET', '/customers.xml?page=1', 0.002)):
+            stats.observe(event)
+        self.assertEqual(sorted(stats.endpoints), [
+            ('GET', '/customers.xml'), ('GET', '/customers/:id.xml'),
+            ('PUT', '/customers/:id.xml')])
+        customer = stats.endpoints[('GET', '/customers/:id.xml')]
+        self.assertEqual((customer.requests, customer.errors, customer.retries,
+            customer.bytes_out, customer.bytes_in), (3, 1, 2, 300, 6144))
+        total = customer.timings['total_time']
+        self.assertAlmostEqual(total.mean, 0.014)
+        self.assertEqual((total.percentile(50), total.percentile(99)),
+            (0.01, 0.03))
+        self.assertEqual(customer.timings['parse_time'].count, 0)
+        self.assertEqual(stats.endpoints[('PUT', '/customers/:id.xml')].errors,
+            1)
+
+        lines = stats.dump().splitlines()
+        self.assertEqual(lines[0].split()[:3], ['method', 'endpoint', 'count'])
+        # slowest first
+        self.assertEqual([line.split()[:5] for line in lines[1:]], [
+            ['PUT', '/customers/:id.xml', '1', '1', '0'],
+            ['GET', '/customers/:id.xml', '3', '1', '2'],
+            ['GET', '/customers.xml', '1', '0', '0']])
+        self.assertEqual(lines[2].split()[5:], ['0.3', '6.0', '14.0', '10.0',
+            '30.0', '7.0', '-'])
+        stats.reset()
+        self.assertEqual(stats.dump().splitlines()[1:], [])
+
+    def test_observer(self):
+        def respond(method, path, query):
+            if path == '/customers/2.xml':
+                return 404, b''
+            return 200, CUSTOMER_XML
+        stats = RequestStats()
+        server, chargify = self.serve(respond, observers=[stats])
+        chargify.Customer().getById(1)
+        chargify.Customer().getById(3)
+        self.assertRaises(ChargifyNotFound, chargify.Customer().getById, 2)
+        customer = stats.endpoints[('GET', '/customers/:id.xml')]
+        self.assertEqual((customer.requests, customer.errors), (3, 1))
+        self.assertEqual(customer.bytes_in, 2 * len(CUSTOMER_XML))
+        self.assertEqual(customer.timings['total_time'].count, 3)
+        self.assertEqual(customer.timings['parse_time'].count, 2)
+
+
+class CustomerSubscriptionsTest(StubApiTest):
+    def serve_subscriptions(self, delays={}, missing=()):
+        def respond(method, path, query):
+            customer = int(path.split('/')[2])
+            if customer in missing:
+                return 404, b''
+            time.sleep(delays.get(customer, 0.01))
+            return 200, xml_array('subscriptions', [SUBSCRIPTION_XML.replace(
+                '<id type="integer">1</id>', '<id type="integer">%d</id>' % (
+                customer * 10 + i), 1) for i in range(2)])
+        return self.serve(respond)
+
+    def customers(self, server):
+        time.sleep(0.1)
+        return sorted(int(path.split('/')[2])
+            for n, method, path in server.requests)
+
+    def test_pairs_as_they_arrive(self):
+        server, chargify = self.serve_subscriptions(delays={1: 0.2})
+        pairs = list(chargify.Subscription().getByCustomerIds(range(1, 7),
+            workers=2))
+        self.assertEqual(sorted((customer, [s.id for s in subscriptions])
+            for customer, subscriptions in pairs), [(customer,
+            [customer * 10, customer * 10 + 1]) for customer in range(1, 7)])
+        # the slow first customer comes last
+        self.assertEqual(pairs[-1][0], 1)
+        self.assertEqual(server.max_active, 2)
+        self.assertEqual(list(chargify.Subscription().getByCustomerIds([])),
+            [])
+
+    def test_error(self):
+        server, chargify = self.serve_subscriptions(missing=(1,))
+        pairs = chargify.Subscription().getByCustomerIds(range(1, 41),
+            workers=2)
+        self.assertRaises(ChargifyNotFound, list, pairs)
+        # the fetches queued behind it were dropped
+        self.assertTrue(len(self.customers(server)) < 40)
+
+    def test_close_early(self):
+        server, chargify = self.serve_subscriptions()
+        pairs = chargify.Subscription().getByCustomerIds(range(1, 41),
+            workers=2)
+        customer, subscriptions = next(pairs)
+        pairs.close()
+        self.assertTrue(len(self.customers(server)) <= 4)